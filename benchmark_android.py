@@ -0,0 +1,370 @@
+#!/usr/bin/env python3
+# Runs install_android.py end to end with stand-in archives served locally
+# and a stub for the compilers and build tools, and reports wall time, CPU
+# time, parallel efficiency and I/O of each phase.
+import argparse
+import subprocess
+import os
+import sys
+import io
+import json
+import random
+import shutil
+import tarfile
+import zipfile
+import tempfile
+import socket
+import resource
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+import install_android
+
+# stands in for every tool, what it does depends on the name it is run as
+STUB = r'''#!/usr/bin/env python3
+import os, sys, time, zipfile
+name = os.path.basename(sys.argv[0])
+a = sys.argv[1:]
+
+def env(key, default):
+    return float(os.environ.get(key, default))
+
+def burn(seconds):
+    end = time.process_time() + seconds
+    while time.process_time() < end:
+        pass
+
+def setup(build, prefix, source):
+    os.makedirs(build, exist_ok = True)
+    open(build + "/.bench_prefix", "w").write(prefix)
+    open(build + "/.bench_source", "w").write(source)
+    time.sleep(env("BENCH_SLEEP", "0"))
+    burn(env("BENCH_CPU", "0") / 4)
+
+def install(build):
+    prefix = open(build + "/.bench_prefix").read()
+    source = open(build + "/.bench_source").read()
+    files = open(source + "/.bench_files").read().split()
+    options = build + "/.bench_options"
+    if os.path.exists(options) and "-DWANT_MONOLITH=on" in open(options).read().split("\n"):
+        files = [x for x in files if not x.startswith("lib/")] + ["lib/liballegro_monolith.so"]
+    size = int(env("BENCH_OUTPUT", "0"))
+    for f in files:
+        path = os.environ.get("DESTDIR", "") + prefix + "/" + f
+        os.makedirs(os.path.dirname(path), exist_ok = True)
+        open(path, "wb").write(f.encode("utf8") + b"\0" * size)
+
+# burns the CPU time of a build split into units, up to slots of them at
+# once, make gets its slots from the jobserver
+def compile(slots):
+    units = int(env("BENCH_UNITS", "8"))
+    tokens = []
+    jobserver = None
+    for x in os.environ.get("MAKEFLAGS", "").split():
+        if x.startswith("--jobserver-auth=") and slots is None:
+            r, w = [int(y) for y in x.split("=")[1].split(",")]
+            jobserver = os.open("/proc/self/fd/%d" % r, os.O_RDONLY | os.O_NONBLOCK), w
+            while len(tokens) < units - 1:
+                try:
+                    token = os.read(jobserver[0], 1)
+                except BlockingIOError:
+                    break
+                if not token:
+                    break
+                tokens.append(token)
+    slots = slots or len(tokens) + 1
+    running = 0
+    for i in range(units):
+        if running == slots:
+            os.wait()
+            running -= 1
+        if os.fork() == 0:
+            burn(env("BENCH_CPU", "0") / units)
+            os._exit(0)
+        running += 1
+    while running:
+        os.wait()
+        running -= 1
+    if tokens:
+        os.write(jobserver[1], b"".join(tokens))
+
+if name == "configure":
+    prefix = [x[9:] for x in a if x.startswith("--prefix=")][0]
+    setup(os.getcwd(), prefix, os.path.dirname(os.path.abspath(sys.argv[0])))
+elif name == "cmake":
+    build = os.getcwd()
+    source = [x for x in a if not x.startswith("-") and os.path.isdir(x)][0]
+    prefix = [x.split("=", 1)[1] for x in a if x.startswith("-DCMAKE_INSTALL_PREFIX=")][0]
+    setup(build, prefix, os.path.abspath(source))
+    open(build + "/.bench_options", "w").write("\n".join(a))
+    generator = a[a.index("-G") + 1] if "-G" in a else "Unix Makefiles"
+    open(build + "/CMakeCache.txt", "w").write("CMAKE_GENERATOR:INTERNAL=" + generator + "\n")
+elif name in ["make", "ninja"]:
+    if "install" in a:
+        install(os.getcwd())
+    else:
+        jobs = [int(x[2:]) for x in a if x.startswith("-j") and x[2:].isdigit()]
+        compile(jobs[0] if name == "ninja" and jobs else None)
+elif name == "sdkmanager":
+    sys.stdin.read()
+    time.sleep(env("BENCH_SLEEP", "0"))
+elif name == "llvm-strip":
+    # the stand-in libraries have nothing to strip
+    output = a[a.index("-o") + 1]
+    open(output, "wb").write(open(a[-1], "rb").read())
+elif name in ["llvm-nm", "llvm-readelf"]:
+    # no sections or symbols to list, --size-report then shows just the sizes
+    pass
+elif name == "gradlew":
+    time.sleep(env("BENCH_SLEEP", "0"))
+    burn(env("BENCH_CPU", "0"))
+    variant = [x[8:].lower() for x in a if x.startswith("assemble")][0]
+    os.makedirs("allegro/build/outputs/aar", exist_ok = True)
+    with zipfile.ZipFile("allegro/build/outputs/aar/allegro5-" + variant + ".aar", "w") as z:
+        for source in ["allegro/src/main", "allegro/src/" + variant]:
+            for root, dirs, files in os.walk(source):
+                for f in files:
+                    z.write(os.path.join(root, f))
+'''
+
+# tools of the NDK toolchain setup_host() points to
+HOSTS = ["arm-linux-androideabi", "i686-linux-android", "x86_64-linux-android",
+    "aarch64-linux-android"]
+COMPILERS = ["armv7a-linux-androideabi16", "i686-linux-android17",
+    "x86_64-linux-android21", "aarch64-linux-android21"]
+LLVM = ["llvm-ar", "llvm-ranlib", "llvm-readelf", "llvm-nm", "llvm-strip"]
+
+# incompressible but reproducible
+def payload(name, megabytes):
+    return random.Random(name).randbytes(int(megabytes * 1e6))
+
+def write_archive(path, files):
+    top = os.path.basename(path).split(".")[0]
+    if path.endswith(".zip"):
+        with zipfile.ZipFile(path, "w") as z:
+            for name, (data, mode) in files.items():
+                info = zipfile.ZipInfo(top + "/" + name)
+                info.external_attr = (0o100000 | mode) << 16
+                z.writestr(info, data)
+        return
+    with tarfile.open(path, "w:" + path.rsplit(".", 1)[1]) as t:
+        for name, (data, mode) in files.items():
+            info = tarfile.TarInfo(top + "/" + name)
+            info.size = len(data)
+            info.mode = mode
+            t.addfile(info, io.BytesIO(data))
+
+def library_files(library):
+    files = ["lib/lib" + library + ".a", "include/" + library + ".h"]
+    if library == "vorbis":
+        files += ["lib/libvorbisfile.a"]
+    return files
+
+# a stand-in archive for every URL in Settings
+def make_archives(www, server):
+    stub = STUB.encode("utf8")
+    archives = {}
+    for library in install_android.Settings.libraries:
+        files = {
+            "configure" : (stub, 0o755),
+            "CMakeLists.txt" : (b"project(" + library.encode("utf8") + b")\n", 0o644),
+            ".bench_files" : ("\n".join(library_files(library)).encode("utf8"), 0o644),
+            "payload.bin" : (payload(library, args.size), 0o644),
+            }
+        if library == "minimp3":
+            files["minimp3.h"] = (b"\n", 0o644)
+            files["minimp3_ex.h"] = (b"\n", 0o644)
+        archives[library + "_url"] = files
+
+    tools = "toolchains/llvm/prebuilt/linux-x86_64/bin/"
+    ndk = {"build/cmake/android.toolchain.cmake" : (b"\n", 0o644),
+        "payload.bin" : (payload("ndk", args.size * 8), 0o644)}
+    for host in HOSTS:
+        for tool in ["ar", "as", "ld", "ranlib", "strip"]:
+            ndk[tools + host + "-" + tool] = (stub, 0o755)
+    for compiler in COMPILERS:
+        ndk[tools + compiler + "-clang"] = (stub, 0o755)
+        ndk[tools + compiler + "-clang++"] = (stub, 0o755)
+    for tool in LLVM:
+        ndk[tools + tool] = (stub, 0o755)
+    archives["ndk_zip_url"] = ndk
+    archives["sdk_tgz_url"] = {"bin/sdkmanager" : (stub, 0o755),
+        "payload.bin" : (payload("sdk", args.size * 4), 0o644)}
+    archives["jdk_url"] = {"jre/bin/java" : (b"#!/bin/sh\n", 0o755),
+        "payload.bin" : (payload("jdk", args.size * 4), 0o644)}
+
+    urls = {}
+    for key, files in archives.items():
+        url, name = install_android.archive_name(getattr(install_android.Settings, key))
+        write_archive(www + "/" + name, files)
+        urls[key] = (server + name, name)
+    return urls
+
+def make_allegro(path):
+    os.makedirs(path + "/include/allegro5", exist_ok = True)
+    with open(path + "/include/allegro5/base.h", "w") as f:
+        for i, x in enumerate(["VERSION", "SUB_VERSION", "WIP_VERSION", "RELEASE_NUMBER"]):
+            f.write("#define ALLEGRO_" + x + " " + "5271"[i] + "\n")
+    open(path + "/include/allegro5/allegro5.h", "w").write("\n")
+    open(path + "/CMakeLists.txt", "w").write("project(allegro)\n")
+    files = ["lib/lib" + x + ".so" for x in install_android.Settings.addons]
+    files += ["include/allegro5/base.h", "include/allegro5/allegro5.h"]
+    open(path + "/.bench_files", "w").write("\n".join(files))
+    gradle = path + "/android/gradle_project"
+    os.makedirs(gradle + "/allegro/src/main/java", exist_ok = True)
+    open(gradle + "/allegro/src/main/java/Activity.java", "w").write("class Activity {}\n")
+    open(gradle + "/gradlew", "w").write(STUB)
+    os.chmod(gradle + "/gradlew", 0o755)
+
+# in its own process, so its I/O does not count for the phases
+def serve(www):
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        port = sock.getsockname()[1]
+    server = subprocess.Popen([sys.executable, "-m", "http.server",
+        "--bind", "127.0.0.1", "--directory", www, str(port)],
+        stdout = subprocess.DEVNULL, stderr = subprocess.DEVNULL)
+    while True:
+        try:
+            socket.create_connection(("127.0.0.1", port)).close()
+            break
+        except ConnectionRefusedError:
+            time.sleep(0.05)
+    return server, "http://127.0.0.1:" + str(port) + "/"
+
+# includes all the processes waited for
+def read_io():
+    counters = {}
+    for row in open("/proc/self/io"):
+        key, value = row.split(":")
+        counters[key] = int(value)
+    return counters["rchar"], counters["wchar"]
+
+# runs install_android.py with the URLs replaced
+CHILD = """
+import json, os, sys
+sys.path.insert(0, os.environ["BENCH_DIR"])
+import install_android
+for key, url in json.loads(os.environ["BENCH_URLS"]).items():
+    setattr(install_android.Settings, key, tuple(url))
+sys.argv[0] = install_android.__file__
+install_android.main()
+"""
+
+def run_phase(name, options, work, env):
+    command = [sys.executable, "-c", CHILD, *options, "-P", work,
+        "-j", str(args.jobs), "--cache", work + "/cache", *args.options]
+    before = resource.getrusage(resource.RUSAGE_CHILDREN)
+    read, written = read_io()
+    start = time.time()
+    with open(work + "/" + name + ".out", "w") as out:
+        p = subprocess.run(command, cwd = work, env = env,
+            stdout = out, stderr = subprocess.STDOUT)
+    wall = time.time() - start
+    after = resource.getrusage(resource.RUSAGE_CHILDREN)
+    read2, written2 = read_io()
+    if p.returncode != 0:
+        sys.stderr.write(name + " failed:\n")
+        sys.stderr.write("".join(open(work + "/" + name + ".out").readlines()[-install_android.Settings.log_tail:]))
+        sys.exit(1)
+    cpu = (after.ru_utime - before.ru_utime) + (after.ru_stime - before.ru_stime)
+    return {"wall" : wall, "cpu" : cpu, "efficiency" : cpu / (wall * args.jobs),
+        "read" : read2 - read, "written" : written2 - written}
+
+def run(work):
+    www = work + "/www"
+    os.makedirs(www)
+    server, url = serve(www)
+    urls = make_archives(www, url)
+    make_allegro(work + "/allegro")
+    bin = work + "/bin"
+    os.makedirs(bin)
+    for tool in ["cmake", "make", "ninja"]:
+        open(bin + "/" + tool, "w").write(STUB)
+        os.chmod(bin + "/" + tool, 0o755)
+
+    env = dict(os.environ)
+    env["PATH"] = bin + ":" + env["PATH"]
+    env["BENCH_DIR"] = os.path.dirname(os.path.abspath(__file__))
+    env["BENCH_URLS"] = json.dumps(urls)
+    env["BENCH_SLEEP"] = str(args.sleep)
+    env["BENCH_CPU"] = str(args.cpu)
+    env["BENCH_UNITS"] = str(args.units)
+    env["BENCH_OUTPUT"] = str(int(args.output * 1e6))
+    allegro = ["-a", work + "/allegro"]
+    phases = {}
+    try:
+        phases["install"] = run_phase("install", ["-i"], work, env)
+        phases["build"] = run_phase("build", ["-b", *allegro], work, env)
+        phases["package"] = run_phase("package", ["-p", *allegro], work, env)
+    finally:
+        server.kill()
+        server.wait()
+    return phases
+
+def megabytes(n):
+    return "%.1f MB" % (n / 1e6)
+
+def report(phases):
+    print("%-8s %9s %9s %11s %10s %10s" % ("phase", "wall", "cpu", "efficiency", "read", "written"))
+    for name, x in phases.items():
+        print("%-8s %8.2fs %8.2fs %10.0f%% %10s %10s" % (name, x["wall"], x["cpu"],
+            100 * x["efficiency"], megabytes(x["read"]), megabytes(x["written"])))
+
+# the phases slower than in the --baseline report
+def compare(phases):
+    baseline = json.load(open(args.baseline))["phases"]
+    slower = []
+    for name, x in phases.items():
+        if name in baseline and x["wall"] > baseline[name]["wall"] * (1 + args.tolerance):
+            slower.append(name)
+            print(name, "took %.2fs, %.2fs before" % (x["wall"], baseline[name]["wall"]))
+    return slower
+
+def main():
+    global args
+    p = argparse.ArgumentParser(description = "Runs install_android.py end to end without the NDK, the SDK or network access.",
+        epilog = "Any options after -- are passed on to install_android.py, for example -- --workers 4 --parallel-archs 2")
+    p.add_argument("-j", "--jobs", type = int, default = len(os.sched_getaffinity(0)),
+        help = "jobs given to install_android.py, parallel efficiency is measured against them, default %(default)s")
+    p.add_argument("--sleep", type = float, default = 0.2,
+        help = "seconds each configure, cmake, sdkmanager and gradlew stub waits, default %(default)s")
+    p.add_argument("--cpu", type = float, default = 0.5,
+        help = "CPU seconds each stub build costs, default %(default)s")
+    p.add_argument("--units", type = int, default = 8,
+        help = "parallel units each stub build is split into, default %(default)s")
+    p.add_argument("--size", type = float, default = 1,
+        help = "megabytes of payload in each library archive, the toolchain archives get more, default %(default)s")
+    p.add_argument("--output", type = float, default = 0.1,
+        help = "megabytes of each file the stub builds install, default %(default)s")
+    p.add_argument("--runs", type = int, default = 1,
+        help = "run everything this often, each phase reports its fastest run")
+    p.add_argument("--work", help = "folder to run in, by default a temporary one which is removed afterwards")
+    p.add_argument("--json", help = "also write the report to this file")
+    p.add_argument("--baseline", help = "report written with --json before, fail if a phase got slower")
+    p.add_argument("--tolerance", type = float, default = 0.1,
+        help = "how much slower than the baseline a phase may get, default %(default)s")
+    p.add_argument("options", nargs = "*", help = argparse.SUPPRESS)
+    args = p.parse_args()
+
+    best = {}
+    for i in range(args.runs):
+        work = args.work or tempfile.mkdtemp(prefix = "benchmark_android.")
+        work = os.path.abspath(work) + "/run" + str(i)
+        shutil.rmtree(work, ignore_errors = True)
+        os.makedirs(work)
+        for name, x in run(work).items():
+            if name not in best or x["wall"] < best[name]["wall"]:
+                best[name] = x
+        if not args.work:
+            shutil.rmtree(os.path.dirname(work))
+
+    report(best)
+    if args.json:
+        settings = {x : getattr(args, x) for x in ["jobs", "sleep", "cpu", "units", "size", "output", "options"]}
+        json.dump({"settings" : settings, "phases" : best}, open(args.json, "w"), indent = 1)
+    if args.baseline and compare(best):
+        sys.exit(1)
+
+if __name__ == "__main__":
+    main()
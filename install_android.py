@@ -4,15 +4,39 @@ import subprocess
 import os
 import shutil
 import urllib.request
+import urllib.error
 import tarfile
 import zipfile
 import glob
 import sys
+import hashlib
+import json
+import io
+import threading
+import concurrent.futures
+import functools
+import time
+import collections
+import contextlib
+import atexit
+import resource
+import stat
+import signal
+import traceback
+import re
+import queue
 
 class Settings:
     jdk_url="http://download.oracle.com/otn-pub/java/jdk/8u131-b11/d54c1d3a095b4ff2b6607d096fa80163/jdk-8u131-linux-x64.tar.gz"
     sdk_tgz_url = "https://dl.google.com/android/repository/sdk-tools-linux-4333796.zip"
     ndk_zip_url = "https://dl.google.com/android/repository/android-ndk-r20-linux-x86_64.zip"
+    # toolchain parts each phase needs, only those are downloaded. The
+    # Allegro configure gets JAVA_HOME and the SDK for its Java part.
+    toolchains = {
+        "install" : ["jdk", "sdk", "ndk"],
+        "build" : ["jdk", "sdk", "ndk"],
+        "package" : ["jdk", "sdk"],
+        }
 
     min_api = {
         "armeabi-v7a" : "16",
@@ -33,12 +57,169 @@ class Settings:
     dumb_url = "https://github.com/kode54/dumb/archive/master.zip", "dumb.zip"
     minimp3_url = "https://github.com/lieff/minimp3/archive/master.zip", "minimp3.zip"
     #theora_url = "https://git.xiph.org/?p=theora.git;a=snapshot;h=HEAD;sf=tgz", "theora.tar.gz"
+    # SHA-256 of the released archives above, by url. Other archives are
+    # checked against the checksum recorded when first downloaded.
+    sha256 = {
+        jdk_url : "62b215bdfb48bace523723cdbb2157c665e6a25429c73828a32f00e587301236",
+        sdk_tgz_url : "92ffee5a1d98d856634e8b71132e8a95d96c83a63fde1099be3d86df3106def9",
+        ndk_zip_url : "57435158f109162f41f2f43d5563d2164e4d5d0364783a9a6fab3ef12cb06ce0",
+        freetype_url : "3a3bb2c4e15ffb433f2032f50a5b5a92558206822e22bfe8cbe339af4aa82f88",
+        ogg_url : "3f687ccdd5ac8b52d76328fbbfebc70c459a40ea891dbf3dccb74a210826e79b",
+        vorbis_url : "54f94a9527ff0a88477be0a71c0bab09a4c3febe0ed878b24824906cd4b0e1d1",
+        physfs_url : "304df76206d633df5360e738b138c94e82ccf086e50ba84f456d3f8432f9f863",
+        flac_url : "91cfc3ed61dc40f47f050a109b08610667d73477af6ef36dcad31c31a4a8d53f",
+        opus_url : "65b58e1e25b2a114157014736a3d9dfeaad8d41be1c8179866f144a2fb44ff9d",
+        opusfile_url : "f75fb500e40b122775ac1a71ad80c4477698842a8fe9da4a1b4a1a9f16e4e979",
+        }
+    # archives which change upstream, a new download replaces the checksum
+    # recorded for them instead of failing
+    floating = [dumb_url[0], minimp3_url[0]]
     build_tools_version = "28.0.0"
+    download_chunk = 1 << 20
+    # the jobserver pipe holds a token for each job, it cannot take more
+    # than its 64K capacity
+    max_jobs = 1 << 16
+    # decompressors tar uses for tarballs, the first one installed is used
+    # so the parallel ones come first
+    decompressors = {
+        ".gz" : ["pigz", "gzip"],
+        ".bz2" : ["lbzip2", "pbzip2", "bzip2"],
+        ".xz" : ["pixz", "xz -T0"],
+        ".zst" : ["zstd -T0"],
+        }
+    # lines of output shown when a command fails
+    log_tail = 40
+    # slowest steps listed by --profile
+    profile_rows = 25
+    # seconds between download progress reports
+    download_progress = 5
+    # seconds between the scans of --watch without inotifywait
+    watch_poll = 1
+    # largest symbols of each library listed by --size-report
+    size_symbols = 20
+
+    # libraries built by --install, in this order unless --workers allows
+    # running several at once
+    # png is not supported on Android right now, Allegro always uses native png
+    # theora can't get it to compile for android
+    libraries = ["freetype", "ogg", "vorbis", "physfs", "flac", "opus",
+        "opusfile", "dumb", "minimp3"]
+    # which libraries need to be installed before the given one can be built
+    dependencies = {
+        "vorbis" : ["ogg"],
+        "opusfile" : ["opus", "ogg"],
+        "allegro" : libraries,
+        "allegro-debug" : libraries,
+        }
+    # Allegro options which are only turned on if the library is built
+    allegro_options = {
+        "freetype" : ["WANT_TTF"],
+        "vorbis" : ["WANT_VORBIS"],
+        "physfs" : ["WANT_PHYSFS"],
+        "flac" : ["WANT_FLAC"],
+        "opusfile" : ["WANT_OPUS"],
+        "dumb" : ["WANT_MODAUDIO"],
+        "minimp3" : ["WANT_MP3"],
+        }
+    # compiler and linker flags of each --optimize profile
+    profiles = {
+        "size" : (["-Os", "-ffunction-sections", "-fdata-sections"],
+            ["-Wl,--gc-sections"]),
+        "speed" : (["-O3", "-ffunction-sections", "-fdata-sections"],
+            ["-Wl,--gc-sections"]),
+        "speed-lto" : (["-O3", "-ffunction-sections", "-fdata-sections", "-flto=thin"],
+            ["-Wl,--gc-sections", "-flto=thin", "-fuse-ld=lld"]),
+        }
+    # compiler flags added for the architecture with any --optimize profile
+    abi_flags = {
+        "armeabi-v7a" : ["-mfpu=neon"],
+        "x86" : ["-mssse3", "-mfpmath=sse"],
+        }
+    # libraries allegro.cmake links, if they were built, each after the
+    # ones it needs
+    addons = ["allegro", "allegro_audio", "allegro_acodec", "allegro_color",
+        "allegro_font", "allegro_image", "allegro_primitives", "allegro_ttf"]
+    # the other addons an addon needs besides allegro, by allegro.cmake
+    addon_dependencies = {
+        "allegro_acodec" : ["allegro_audio"],
+        "allegro_ttf" : ["allegro_font"],
+        }
+    variants = ["debug", "release"]
+    # what the Allegro core library needs linked, by allegro.cmake
+    system_libraries = ["m", "z", "log", "GLESv2"]
+    # top folders of the Allegro sources not going into the libraries,
+    # changes there do not make --watch build again
+    unbuilt = ["demos", "docs", "examples", "python", "tests"]
+    # static libraries of the optional libraries linked into Allegro, by
+    # which --size-report tells what each of them adds
+    archives = {
+        "freetype" : ["libfreetype.a"],
+        "ogg" : ["libogg.a"],
+        "vorbis" : ["libvorbis.a", "libvorbisfile.a"],
+        "physfs" : ["libphysfs.a"],
+        "flac" : ["libFLAC.a"],
+        "opus" : ["libopus.a"],
+        "opusfile" : ["libopusfile.a"],
+        "dumb" : ["libdumb.a"],
+        }
     
 s = Settings()
 
+# environment, directory and log com() uses in the current thread
+class Context(threading.local):
+    def __init__(self):
+        self.env = None
+        self.cwd = None
+        self.log = None
+        self.job = None
+        self.steps = 0
+
+ctx = Context()
+autogen_lock = threading.Lock()
+processes_lock = threading.Lock()
+
+class CommandFailed(Exception):
+    def __init__(self, command, log, tail):
+        super().__init__(" ".join(command) + " failed, see " + log)
+        self.command = command
+        self.log = log
+        self.tail = tail
+
+class Cancelled(Exception):
+    pass
+
+# a GNU make jobserver shared by all builds, so at most -j compilers run at once
+class Jobserver:
+    def __init__(self, jobs):
+        self.jobs = jobs
+        self.read, self.write = os.pipe()
+        os.write(self.write, b"+" * jobs)
+        # a separate non-blocking handle on the same pipe, so try_acquire()
+        # does not change the blocking mode the makes see
+        self.poll = os.open("/proc/self/fd/" + str(self.read), os.O_RDONLY | os.O_NONBLOCK)
+
+    def acquire(self):
+        return os.read(self.read, 1)
+
+    def try_acquire(self):
+        try:
+            return os.read(self.poll, 1)
+        except BlockingIOError:
+            return None
+
+    def release(self, token):
+        os.write(self.write, token)
+
+    def makeflags(self):
+        return "-j" + str(self.jobs) + " --jobserver-auth=" + str(self.read) + "," + str(self.write)
+
 def main():
     global args
+    s.processes = set()
+    s.cancelled = threading.Event()
+    s.failed = set()
+    s.failures = []
+    s.modified = set()
     path = os.getcwd()
     p = argparse.ArgumentParser()
     p.add_argument("-i", "--install", action = "store_true")
@@ -48,13 +229,71 @@ def main():
     p.add_argument("-a", "--allegro", help = "path to allegro")
     p.add_argument("-P", "--path", help = "path to install to, by default current directory")
     p.add_argument("-A", "--arch", help = "comma separated list of architectures, by default all are built: " + (", ".join(Settings.architectures)))
-    p.add_argument("-D", "--debug", action = "store_true", help = "build debug libraries")
+    p.add_argument("-D", "--debug", action = "store_true", help = "build debug libraries, same as --variants debug, not with --variants")
+    p.add_argument("--variants", help = "comma separated list of variants to build and package in one run: " + (", ".join(Settings.variants)) + ", by default release")
     p.add_argument("-E", "--extra", help = "extra version suffix")
+    p.add_argument("-C", "--components", help = "comma separated list of optional libraries to build and use, the ones they need are added, by default all: " + (", ".join(Settings.libraries)))
+    p.add_argument("-j", "--jobs", type = jobs, metavar = "N",
+        help = "total number of compile jobs shared by all builds, by default the number of CPUs")
+    p.add_argument("-M", "--monolith", action = "store_true",
+        help = "build Allegro and all its addons as the single library allegro_monolith")
+    p.add_argument("-O", "--optimize", choices = list(Settings.profiles),
+        help = "build all libraries with the compiler and linker flags of this profile, by default the ones of each build system are used")
+    p.add_argument("--incremental", action = "store_true",
+        help = "keep the Allegro build trees between runs and only rebuild what changed")
+    p.add_argument("--ninja", action = "store_true",
+        help = "use the Ninja generator for the CMake based builds")
+    p.add_argument("--launcher", metavar = "PROGRAM",
+        help = "compiler launcher to use for all builds, for example ccache")
+    p.add_argument("--parallel-archs", type = int, default = 1, metavar = "N",
+        help = "build up to N architectures of Allegro at the same time, with --install the same as --workers N, "
+            "each build logging to output-<arch>/build/<name>.log")
+    p.add_argument("--workers", type = int, default = 1, metavar = "N",
+        help = "with --install run up to N library/architecture builds at the same time, as soon as the libraries they need are installed")
+    p.add_argument("--downloads", type = int, default = 4, metavar = "N",
+        help = "download and unpack up to N archives at the same time before building, default 4")
+    p.add_argument("-k", "--keep-going", action = "store_true",
+        help = "after a job failed keep building everything which does not need it, by default the first failure stops the whole run")
+    p.add_argument("--rebuild", action = "store_true",
+        help = "rebuild the libraries even if their build stamps are up to date")
+    p.add_argument("--profile", action = "store_true",
+        help = "measure every step and command and write install_android.profile.json")
+    p.add_argument("--artifacts", metavar = "LOCATION",
+        help = "folder or http(s) URL of a cache of built libraries shared between hosts, "
+            "libraries found there are unpacked instead of built and the ones built are added")
+    p.add_argument("--size-report", action = "store_true",
+        help = "after building list the section sizes, largest symbols and the size each static library adds "
+            "to the Allegro libraries of every architecture, also written to install_android.sizes.json")
+    p.add_argument("--size-budget", action = "append", default = [], metavar = "[NAME=]SIZE",
+        help = "with --size-report fail if the stripped release libraries of an architecture together are larger "
+            "than SIZE, in bytes or with a K or M suffix. With NAME only that architecture or library, "
+            "like liballegro_audio.so. Can be given several times")
+    p.add_argument("--watch", action = "store_true",
+        help = "after building and packaging keep running, and build and package again "
+            "whatever changes below the Allegro sources affect, implies --incremental")
+    p.add_argument("--watch-libraries", action = "store_true",
+        help = "with --watch also rebuild a library when its unpacked sources in downloads/ change")
+    p.add_argument("--debounce", type = float, default = 1, metavar = "SECONDS",
+        help = "with --watch wait until nothing changed for this long before building, default %(default)s")
+    p.add_argument("--cache", default = os.path.join(os.environ.get("XDG_CACHE_HOME",
+        os.path.expanduser("~/.cache")), "allegro-android"),
+        help = "download cache shared by all install paths, default %(default)s")
 
     args = p.parse_args()
     if not args.path:
         args.path = os.getcwd()
     s.log = open(args.path + "/install_android.log", "w")
+    if not args.jobs:
+        args.jobs = min(len(os.sched_getaffinity(0)), s.max_jobs)
+    s.jobserver = Jobserver(args.jobs)
+    s.scheduler = None
+    s.checksums = {}
+    s.verified = {}
+    s.started = time.time()
+    s.profile = []
+    s.open_steps = []
+    if args.profile:
+        atexit.register(write_profile)
 
     if args.arch:
         archs = args.arch.split(",")
@@ -63,24 +302,60 @@ def main():
                 sys.stderr.write("Unknown architecture " + a + "\n")
                 sys.exit(-1)
         s.architectures = archs
-    s.sdk = download_and_unpack(s.sdk_tgz_url, "tools")
-    s.ndk = download_and_unpack(s.ndk_zip_url)
-    setup_jdk()
-    
+    if args.variants:
+        if args.debug:
+            sys.stderr.write("-D and --variants cannot be combined, use --variants debug\n")
+            sys.exit(-1)
+        args.variants = args.variants.split(",")
+        for v in args.variants:
+            if v not in s.variants:
+                sys.stderr.write("Unknown variant " + v + "\n")
+                sys.exit(-1)
+    else:
+        args.variants = ["debug" if args.debug else "release"]
+    if args.components:
+        wanted = args.components.split(",")
+        for c in wanted:
+            if c not in s.libraries:
+                sys.stderr.write("Unknown component " + c + "\n")
+                sys.exit(-1)
+        s.components = [x for x in s.libraries if x in resolve(wanted)]
+    else:
+        s.components = s.libraries
+    s.budgets = {}
+    for budget in args.size_budget:
+        name, _, size = budget.rpartition("=")
+        try:
+            s.budgets[name] = parse_size(size)
+        except ValueError:
+            sys.stderr.write("Bad size budget " + budget + "\n")
+            sys.exit(-1)
+        if name and name not in s.architectures and not re.match(r"liballegro\w*\.so$", name):
+            sys.stderr.write("Unknown architecture or library in size budget " + budget + "\n")
+            sys.exit(-1)
+    if args.watch:
+        if not args.build and not args.package:
+            sys.stderr.write("Need -b or -p to watch\n")
+            sys.exit(-1)
+        args.incremental = True
+    for tool in ["ninja" if args.ninja else None, args.launcher]:
+        if tool and not shutil.which(tool):
+            sys.stderr.write("Cannot find " + tool + "\n")
+            sys.exit(-1)
+    phases = [x for x in s.toolchains if getattr(args, x)]
+    s.jdk = unpacked_folder(s.jdk_url)
+    s.sdk = unpacked_folder(s.sdk_tgz_url)
+    s.ndk = unpacked_folder(s.ndk_zip_url)
+    with timed("phase", "prefetch"):
+        prefetch(phases)
+
     if args.install:
-        install_sdk()
-        install_ndk()
-        install_freetype()
-        install_ogg()
-        install_vorbis()
-        # not supported on Android right now, always uses native png()
-        install_physfs()
-        install_flac()
-        install_opus()
-        install_opusfile()
-        install_dumb()
-        install_minimp3()
-        # can't get it to compile for android install_theora()
+        with timed("phase", "install"):
+            provision("install")
+            with job_logs("sdk"):
+                install_sdk()
+            install_ndk()
+            install_libraries(s.components)
 
     if args.build or args.package:
         if not args.allegro:
@@ -95,13 +370,57 @@ def main():
         if not s.version:
             print("Cannot find version!")
             return
+
+    if args.watch:
+        watch()
+        return
         
     if args.build:
-        build_allegro()
+        with timed("phase", "build"):
+            provision("build")
+            build_allegro()
+
+    if args.size_report:
+        with timed("phase", "size report"):
+            provision("build")
+            size_report()
 
     if args.package:
         print("Packaging version", s.version)
-        build_aar()
+        with timed("phase", "package"), job_logs("package"):
+            provision("package")
+            build_aar()
+
+    if report_failures():
+        sys.exit(1)
+
+def report_failures():
+    if not s.failures:
+        return False
+    sys.stderr.write(str(len(s.failures)) + " jobs failed: " +
+        ", ".join(" ".join(x) for x in s.failures) + "\n")
+    skipped = s.failed - set(s.failures)
+    if skipped:
+        sys.stderr.write("skipped because they need them: " +
+            ", ".join(" ".join(x) for x in sorted(skipped)) + "\n")
+    return True
+
+def jobs(text):
+    n = int(text)
+    if n < 1 or n > s.max_jobs:
+        raise argparse.ArgumentTypeError("must be between 1 and " + str(s.max_jobs))
+    return n
+
+# the given libraries with all the ones they need
+def resolve(libraries):
+    result = set()
+    todo = list(libraries)
+    while todo:
+        library = todo.pop()
+        if library not in result:
+            result.add(library)
+            todo += s.dependencies.get(library, [])
+    return result
 
 def parse_version():
     x = [
@@ -118,41 +437,205 @@ def parse_version():
     if args.extra:
         s.version += args.extra
 
+def log(text):
+    (ctx.log or s.log).write(text + "\n")
+
+# each command run inside logs to its own file in logs/<job>/
+@contextlib.contextmanager
+def job_logs(*job):
+    previous = ctx.job, ctx.steps
+    ctx.job, ctx.steps = job, 0
+    try:
+        yield
+    finally:
+        ctx.job, ctx.steps = previous
+
+def step_log(command):
+    folder = args.path + "/logs/" + "/".join(x.replace(" ", "_") for x in ctx.job or ["main"])
+    if ctx.steps == 0:
+        # only drop the logs of the last run once there is something new
+        shutil.rmtree(folder, ignore_errors = True)
+        os.makedirs(folder, exist_ok = True)
+    ctx.steps += 1
+    step = os.path.basename(command[0])
+    if "install" in command[1:]:
+        step += "-install"
+    return folder + "/" + "%02d" % ctx.steps + "-" + step + ".log"
+
+# records wall and CPU time of everything inside for --profile
+@contextlib.contextmanager
+def timed(kind, name, **extra):
+    record = {"kind" : kind, "name" : name, "job" : ctx.job,
+        "thread" : threading.get_ident(), "start" : time.time() - s.started,
+        "cpu" : 0.0, "rss" : 0}
+    record.update(extra)
+    clock = time.process_time if kind == "phase" else time.thread_time
+    cpu = clock()
+    s.open_steps.append(record)
+    try:
+        yield record
+    finally:
+        s.open_steps.remove(record)
+        record["wall"] = time.time() - s.started - record["start"]
+        record["cpu"] += clock() - cpu
+        s.profile.append(record)
+
+def add_usage(cpu, rss):
+    for step in list(s.open_steps):
+        if step["kind"] == "phase" or step["thread"] == threading.get_ident():
+            step["cpu"] += cpu
+            step["rss"] = max(step["rss"], rss)
+
+# total wall time and keys of the longest chain of dependent jobs
+def critical_path(jobs):
+    by_key = {x["key"] : x for x in jobs}
+    longest = {}
+    def chain(key):
+        if key not in longest:
+            before = max((chain(x) for x in by_key[key]["needs"] if x in by_key),
+                key = lambda x: x[0], default = (0, []))
+            longest[key] = before[0] + by_key[key]["wall"], before[1] + [key]
+        return longest[key]
+    return max((chain(x) for x in by_key), key = lambda x: x[0], default = (0, []))
+
+def write_profile():
+    name = args.path + "/install_android.profile.json"
+    jobs = [x for x in s.profile if x["kind"] == "job"]
+    architectures = {}
+    for arch in s.architectures:
+        mine = [x for x in jobs if x["key"][1] == arch]
+        wall, path = critical_path(mine)
+        architectures[arch] = {"wall" : sum(x["wall"] for x in mine),
+            "cpu" : sum(x["cpu"] for x in mine),
+            "critical_path" : {"wall" : wall, "jobs" : path}}
+    wall, path = critical_path(jobs)
+    report = {"wall" : time.time() - s.started,
+        "cpu" : time.process_time() + sum(x["cpu"] for x in s.profile if x["kind"] == "command"),
+        "rss" : resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024,
+        "critical_path" : {"wall" : wall, "jobs" : path},
+        "architectures" : architectures,
+        "records" : sorted(s.profile, key = lambda x: x["start"])}
+    for x in report["records"]:
+        x.pop("thread", None)
+    json.dump(report, open(name, "w"), indent = 1)
+
+    print()
+    print("%9s %9s %8s  %s" % ("wall", "cpu", "rss", "step"))
+    for x in sorted(s.profile, key = lambda x: -x["wall"])[:s.profile_rows]:
+        where = " (" + " ".join(x["job"]) + ")" if x["job"] and x["kind"] == "command" else ""
+        print("%8.1fs %8.1fs %6dMB  %s %s%s" % (x["wall"], x["cpu"], x["rss"] >> 20,
+            x["kind"], x["name"][:60], where))
+    print()
+    print("critical path %.1fs:" % wall, " -> ".join(" ".join(x) for x in path))
+    for arch, x in architectures.items():
+        print("%-12s %8.1fs wall %8.1fs cpu, critical path %.1fs" % (arch, x["wall"],
+            x["cpu"], x["critical_path"]["wall"]))
+    print("profile written to", name)
+
 def com(*args, input = None):
+    if s.cancelled.is_set():
+        raise Cancelled()
     args = [x for x in args if x is not None]
     print(" ".join(args))
-    s.log.write(" ".join(args) + "\n")
+    log(" ".join(args))
+    name = step_log(args)
+    log("output in " + name)
+    tail = collections.deque(maxlen = s.log_tail)
+    start = time.time()
+    with open(name, "w") as f:
+        f.write(" ".join(args) + "\n")
+        p = subprocess.Popen(args,
+            env = ctx.env or os.environ, cwd = ctx.cwd,
+            pass_fds = (s.jobserver.read, s.jobserver.write),
+            stdin = subprocess.PIPE if input is not None else None,
+            stdout = subprocess.PIPE, stderr = subprocess.STDOUT,
+            start_new_session = True)
+        with processes_lock:
+            s.processes.add(p)
+        if s.cancelled.is_set():
+            kill(p)
+        if input is not None:
+            p.stdin.write(input)
+            p.stdin.close()
+        for line in p.stdout:
+            line = line.decode("utf8", "replace").rstrip("\n")
+            f.write(time.strftime("%H:%M:%S ") + line + "\n")
+            f.flush()
+            tail.append(line)
+        # wait4 gives us the resources used by just this command
+        pid, status, usage = os.wait4(p.pid, 0)
+        p.returncode = os.waitstatus_to_exitcode(status)
+        with processes_lock:
+            s.processes.discard(p)
+        f.write("exit code " + str(p.returncode) + "\n")
+    cpu = usage.ru_utime + usage.ru_stime
+    s.profile.append({"kind" : "command", "name" : " ".join(args), "job" : ctx.job,
+        "start" : start - s.started, "wall" : time.time() - start,
+        "cpu" : cpu, "rss" : usage.ru_maxrss * 1024, "log" : name})
+    add_usage(cpu, usage.ru_maxrss * 1024)
+    if p.returncode != 0:
+        log("FAILED")
+        if s.cancelled.is_set():
+            raise Cancelled()
+        raise CommandFailed(args, name, list(tail))
+
+# runs a command only to read its output
+def query(*args):
+    log(" ".join(args))
+    p = subprocess.run(args, stdout = subprocess.PIPE, stderr = subprocess.PIPE)
+    if p.returncode != 0:
+        raise CommandFailed(args, s.log.name,
+            p.stderr.decode("utf8", "replace").splitlines()[-s.log_tail:])
+    return p.stdout.decode("utf8", "replace")
+
+def kill(p):
     try:
-        r = subprocess.run(args, check = True, input = input,
-            env = os.environ,
-            stdout = subprocess.PIPE, stderr = subprocess.STDOUT)
-    except subprocess.CalledProcessError as e:
-        r = e
-        sys.stderr.write(" ______\n")
-        sys.stderr.write("/FAILED\\\n")
-        sys.stderr.write("´`´`´`´`\n")
-        s.log.write("FAILED\n")
-    if r.stdout:
-        s.log.write(r.stdout.decode("utf8") + "\n")
-    
+        os.killpg(p.pid, signal.SIGTERM)
+    except ProcessLookupError:
+        pass
+
+# kills the running commands and keeps new ones from starting
+def cancel():
+    s.cancelled.set()
+    with processes_lock:
+        for p in s.processes:
+            kill(p)
+
+def report_failure(e, job = None):
+    sys.stderr.write(" ______\n")
+    sys.stderr.write("/FAILED\\\n")
+    sys.stderr.write("´`´`´`´`\n")
+    if job:
+        sys.stderr.write("in " + " ".join(job) + "\n")
+    if isinstance(e, CommandFailed):
+        sys.stderr.write(" ".join(e.command) + "\n")
+        sys.stderr.write("".join(x + "\n" for x in e.tail))
+        sys.stderr.write("(full output in " + e.log + ")\n")
+    else:
+        traceback.print_exception(type(e), e, e.__traceback__)
+
 def makedirs(name):
-    s.log.write("mkdir -p " + name + "\n")
+    log("mkdir -p " + name)
     print("mkdir -p " + name)
     os.makedirs(name, exist_ok = True)
 
+# only for the commands of the current thread
 def chdir(name):
-    s.log.write("cd " + name + "\n")
+    log("cd " + name)
     print("cd " + name)
-    os.chdir(name)
+    ctx.cwd = name
 
 def write(name, contents, placeholders = {}):
-    print("create", name)
     contents = contents.replace("{", "{{")
     contents = contents.replace("}", "}}")
     contents = contents.replace("«", "{")
     contents = contents.replace("»", "}")
-    contents = contents.format(**placeholders)
-    open(name, "w").write(contents.strip() + "\n")
+    contents = contents.format(**placeholders).strip() + "\n"
+    # left alone when unchanged, so nothing downstream sees it as modified
+    if os.path.exists(name) and open(name).read() == contents:
+        return
+    print("create", name)
+    open(name, "w").write(contents)
 
 def copy(source, destination):
     com("cp", "-r", source, destination)
@@ -167,69 +650,323 @@ def rm(pattern):
     for f in glob.glob(pattern):
         os.unlink(f)
 
+# 4096, 300K or 1.5M in bytes
+def parse_size(text):
+    units = {"K" : 1 << 10, "M" : 1 << 20}
+    text = text.strip().upper()
+    if text[-1:] in units:
+        return int(float(text[:-1]) * units[text[-1]])
+    return int(text)
+
+def megabytes(n):
+    return "%.1f MB" % (n / 1e6)
+
+# streams url to path, resuming a .part file left behind by an earlier run
 def download(url, path):
-    if not os.path.exists(path):
+    if os.path.exists(path):
+        return
+    part = path + ".part"
+    have = os.path.getsize(part) if os.path.exists(part) else 0
+    if have:
+        print("Resuming", url, "at", megabytes(have))
+    else:
         print("Downloading", url)
 
-        req = urllib.request.Request(url)
-        req.add_header("Cookie", "oraclelicense=accept-securebackup-cookie")
+    req = urllib.request.Request(url)
+    req.add_header("Cookie", "oraclelicense=accept-securebackup-cookie")
+    if have:
+        req.add_header("Range", "bytes=" + str(have) + "-")
+    try:
         r = urllib.request.urlopen(req)
-        with open(path + ".part", "wb") as f:
-            f.write(r.read())
-        os.rename(path + ".part", path)
+    except urllib.error.HTTPError as e:
+        if e.code != 416:
+            raise
+        # nothing left to fetch if the .part file already has all of it
+        if e.headers.get("Content-Range", "") == "bytes */" + str(have):
+            os.rename(part, path)
+            return
+        os.unlink(part)
+        return download(url, path)
+    if have and r.status != 206:
+        print("Server does not support resuming, starting over")
+        have = 0
+    size = r.headers.get("Content-Length")
+    size = have + int(size) if size is not None else None
+
+    done = have
+    start = time.time()
+    report = start + s.download_progress
+    with r, open(part, "ab" if have else "wb") as f:
+        while True:
+            if s.cancelled.is_set():
+                raise Cancelled()
+            # whatever arrived, so a cancel is seen while the network is slow
+            chunk = r.read1(s.download_chunk)
+            if not chunk:
+                break
+            f.write(chunk)
+            done += len(chunk)
+            now = time.time()
+            if now >= report:
+                report = now + s.download_progress
+                print(os.path.basename(path) + ":", megabytes(done),
+                    "of " + megabytes(size) if size else "",
+                    "at", megabytes((done - have) / (now - start)) + "/s")
+    if size is not None and done < size:
+        raise IOError("Download of " + url + " stopped after " +
+            megabytes(done) + " of " + megabytes(size) +
+            ", run again to resume")
+    elapsed = max(time.time() - start, 0.001)
+    print("Downloaded", os.path.basename(path), megabytes(done - have), "in",
+        "%.1f s" % elapsed, "(" + megabytes((done - have) / elapsed) + "/s)")
+    os.rename(part, path)
+
+def sha256sum(path):
+    h = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(s.download_chunk), b""):
+            h.update(chunk)
+    return h.hexdigest()
+
+def temp_name(path):
+    return path + ".tmp" + str(os.getpid()) + "-" + str(threading.get_ident())
+
+# hardlink, or a copy across filesystems
+def link_or_copy(source, destination):
+    temp = temp_name(destination)
+    try:
+        os.link(source, temp)
+    except OSError:
+        subprocess.run(["cp", "--reflink=auto", source, temp], check = True)
+    os.replace(temp, destination)
+
+def url_record(url):
+    return args.cache + "/urls/" + hashlib.sha256(url.encode("utf8")).hexdigest()
+
+def cached_sha256(url):
+    if url in s.sha256:
+        return s.sha256[url]
+    if os.path.exists(url_record(url)):
+        return open(url_record(url)).read().strip()
+    return None
+
+# archives are kept in the cache by their SHA-256, every install path links them
+def fetch(url, path):
+    objects = args.cache + "/sha256"
+    os.makedirs(objects, exist_ok = True)
+    os.makedirs(args.cache + "/urls", exist_ok = True)
+    expected = cached_sha256(url)
+    cached = objects + "/" + expected if expected else None
+
+    if os.path.exists(path):
+        if cached and os.path.exists(cached) and os.path.samefile(path, cached):
+            return expected
+        checksum = verified_sha256(path)
+        if expected in (None, checksum):
+            # only copied into the cache if it is not there yet
+            if not os.path.exists(objects + "/" + checksum):
+                link_or_copy(path, objects + "/" + checksum)
+            record_sha256(url, checksum)
+            return checksum
+        print("Checksum mismatch for", path + ", downloading again")
+        os.unlink(path)
+
+    if cached and os.path.exists(cached):
+        print("Using cached", cached)
+        link_or_copy(cached, path)
+        return expected
+    download(url, path)
+    checksum = verified_sha256(path)
+    if expected not in (None, checksum):
+        if url not in s.floating:
+            os.unlink(path)
+            raise IOError("Checksum mismatch for " + url + ": expected " +
+                expected + " but got " + checksum)
+        print(url, "changed upstream, recording its new checksum")
+    # archives are never changed in place, this makes sure nothing
+    # writes through the hardlinks into the cache by accident
+    os.chmod(path, 0o444)
+    link_or_copy(path, objects + "/" + checksum)
+    record_sha256(url, checksum)
+    return checksum
+
+def record_sha256(url, checksum):
+    known = url_record(url)
+    if url not in s.sha256 and cached_sha256(url) != checksum:
+        with open(temp_name(known), "w") as f:
+            f.write(checksum + "\n")
+        os.replace(temp_name(known), known)
+
+# each archive is only hashed once per run, as long as it does not change
+def verified_sha256(path):
+    st = os.stat(path)
+    key = path, st.st_size, st.st_mtime_ns
+    if key not in s.verified:
+        s.verified[key] = sha256sum(path)
+    return s.verified[key]
+
+def strip_top(name):
+    parts = name.split("/", 1)
+    if len(parts) < 2 or not parts[1].strip("/"):
+        return None
+    if parts[1].startswith("/") or ".." in parts[1].split("/"):
+        raise IOError("Refusing to unpack " + name)
+    return parts[1]
+
+# zipfile loses permissions and symlinks, so they are restored by hand
+def unzip(name, destination):
+    with zipfile.ZipFile(name) as z:
+        members = sorted(z.infolist(), key = lambda x: -x.file_size)
+    workers = max(1, min(args.jobs, len(members)))
+
+    def extract(chunk):
+        with zipfile.ZipFile(name) as z:
+            for info in chunk:
+                if s.cancelled.is_set():
+                    raise Cancelled()
+                path = strip_top(info.filename)
+                if path is None:
+                    continue
+                path = destination + "/" + path
+                mode = info.external_attr >> 16
+                if info.is_dir():
+                    os.makedirs(path, exist_ok = True)
+                    continue
+                os.makedirs(os.path.dirname(path), exist_ok = True)
+                if stat.S_ISLNK(mode):
+                    os.symlink(z.read(info).decode("utf8"), path)
+                    continue
+                with z.open(info) as source, open(path, "wb") as f:
+                    shutil.copyfileobj(source, f, s.download_chunk)
+                if mode & 0o777:
+                    os.chmod(path, stat.S_IMODE(mode))
+
+    with concurrent.futures.ThreadPoolExecutor(workers) as pool:
+        for future in [pool.submit(extract, members[i::workers]) for i in range(workers)]:
+            future.result()
+
+def untar(name, destination):
+    if not shutil.which("tar"):
+        with tarfile.open(name) as t:
+            members = []
+            for member in t.getmembers():
+                member.name = strip_top(member.name)
+                if member.name is None:
+                    continue
+                if member.islnk():
+                    member.linkname = strip_top(member.linkname)
+                members.append(member)
+            t.extractall(destination, members)
+        return
+    program = None
+    for extension, candidates in s.decompressors.items():
+        if name.endswith(extension):
+            program = next((x for x in candidates if shutil.which(x.split()[0])), None)
+    com("tar", "-x", "-f", name, "-C", destination, "--strip-components=1",
+        "--use-compress-program=" + program if program else None)
+
+def unpack(name, target_folder):
+    shutil.rmtree(target_folder + ".part", ignore_errors = True)
+    os.makedirs(target_folder + ".part", exist_ok = True)
+
+    print("Unpacking", name)
+    if zipfile.is_zipfile(name):
+        unzip(name, target_folder + ".part")
+    else:
+        untar(name, target_folder + ".part")
+    os.rename(target_folder + ".part", target_folder)
 
-def download_and_unpack(url, sub_folder = None):
+def archive_name(url):
     if type(url) is tuple:
-        url, dest = url
-    else:
-        slash = url.rfind("/")
-        dest = url[slash + 1:]
+        return url
+    slash = url.rfind("/")
+    return url, url[slash + 1:]
+
+def unpacked_folder(url):
+    url, dest = archive_name(url)
+    folder = args.path + "/downloads/" + dest
+    folder = folder[:folder.rfind(".")]
+    if folder.endswith(".tar"):
+        folder = folder[:-4]
+    return folder
+
+def download_and_unpack(url, sub_folder = None):
+    folder = unpacked_folder(url)
+    url, dest = archive_name(url)
     print("Checking", url)
     os.makedirs(args.path + "/downloads", exist_ok = True)
     name = args.path + "/downloads/" + dest
-    download(url, name)
+    with timed("step", "fetch " + dest):
+        checksum = fetch(url, name)
 
-    dot = name.rfind(".")
-    folder = name[:dot]
-    if folder.endswith(".tar"):
-        folder = folder[:-4]
     target_folder = folder
     if sub_folder:
         target_folder += "/" + sub_folder
     if not os.path.exists(target_folder):
-        shutil.rmtree(target_folder + ".part", ignore_errors = True)
-        os.makedirs(target_folder + ".part", exist_ok = True)
-
-        print("Unpacking", name)
-        if zipfile.is_zipfile(name):
-            # doesn't preserve permissions in some python versions
-            #with zipfile.ZipFile(name) as z:
-            #    z.extractall(folder + ".part")
-            com("unzip", "-q", "-d", target_folder + ".part", name)
-        else:
-            tarfile.open(name).extractall(target_folder + ".part")
-
-        for sub in glob.glob(target_folder + ".part/*"):
-            if os.path.isdir(sub):
-                shutil.move(sub, folder)
-                break
-        os.rmdir(target_folder + ".part")
+        with timed("step", "unpack " + dest), job_logs("unpack", dest):
+            unpack(name, target_folder)
 
+    s.checksums[folder] = checksum
     return folder
 
+# downloads and unpacks everything the phases need, several at once
+def prefetch(phases):
+    if args.downloads <= 1:
+        return
+    pieces = set(sum([s.toolchains[x] for x in phases], []))
+    urls = [toolchain_url(x) for x in sorted(pieces)]
+    if args.install:
+        urls += [(getattr(s, x + "_url"), None) for x in s.components]
+    pool = concurrent.futures.ThreadPoolExecutor(args.downloads)
+    futures = [pool.submit(download_and_unpack, url, sub_folder)
+        for url, sub_folder in urls]
+    try:
+        done, _ = concurrent.futures.wait(futures,
+            return_when = concurrent.futures.FIRST_EXCEPTION)
+        for future in list(done) + futures:
+            future.result()
+    except BaseException:
+        # the others stop at their next chunk instead of finishing first
+        cancel()
+        pool.shutdown(cancel_futures = True)
+        raise
+    pool.shutdown()
+
 def setup_jdk():
     s.jdk = download_and_unpack(s.jdk_url)
     set_var("JAVA_HOME", s.jdk + "/jre")
 
+def toolchain_url(piece):
+    return {
+        "jdk" : (s.jdk_url, None),
+        "sdk" : (s.sdk_tgz_url, "tools"),
+        "ndk" : (s.ndk_zip_url, None),
+        }[piece]
+
+# downloads and unpacks only the toolchain parts phase needs
+def provision(phase):
+    for piece in s.toolchains[phase]:
+        if piece == "jdk":
+            setup_jdk()
+        else:
+            url, sub_folder = toolchain_url(piece)
+            setattr(s, piece, download_and_unpack(url, sub_folder))
+
 def install_sdk():
     components = [
         "platform-tools",
         "build-tools;" + s.build_tools_version,
         "platforms;android-28"
         ]
+    stamp = s.sdk + "/.stamp"
+    key = stamp_key(components)
+    if up_to_date(stamp, key):
+        print("SDK components are up to date")
+        return
     sdkmanager = s.sdk + "/tools/bin/sdkmanager"
     for component in components:
         com(sdkmanager, component, "--sdk_root=" + s.sdk, input = b"y\n")
+    write_stamp(stamp, key)
 
 def install_ndk():
     for arch in s.architectures:
@@ -241,17 +978,107 @@ def install_ndk():
 
 def set_var(key, val):
     print(key + "=" + val)
-    os.environ[key] = val
+    env = ctx.env if ctx.env is not None else os.environ
+    env[key] = val
 
 def add_path(val):
     print("PATH=" + val + ":${PATH}")
-    os.environ["PATH"] = val + ":" + os.environ["PATH"]
-
-def backup_path():
-    s.backup_path = os.environ["PATH"]
-
-def restore_path():
-    os.environ["PATH"] = s.backup_path
+    env = ctx.env if ctx.env is not None else os.environ
+    env["PATH"] = val + ":" + env["PATH"]
+
+def restore_env():
+    ctx.env = None
+    ctx.cwd = None
+
+# runs each job in its own thread once the jobs it needs are done
+class Scheduler:
+    def __init__(self, workers):
+        self.workers = max(1, workers)
+        self.jobs = {}
+
+    def add(self, key, function, needs = [], log = None):
+        self.jobs[key] = function, needs, log
+
+    def ready(self, key, done):
+        function, needs, log = self.jobs[key]
+        return all(x in done or x not in self.jobs for x in needs)
+
+    def run_job(self, key):
+        function, needs, log = self.jobs[key]
+        if self.workers > 1 and log:
+            s.log.write(" ".join(key) + ": see " + log + "\n")
+            os.makedirs(os.path.dirname(log), exist_ok = True)
+            ctx.log = open(log, "w")
+        token = s.jobserver.acquire()
+        try:
+            if s.cancelled.is_set():
+                raise Cancelled()
+            with job_logs(*key), timed("job", " ".join(key), key = key, needs = needs):
+                function()
+        finally:
+            s.jobserver.release(token)
+            restore_env()
+            if ctx.log:
+                ctx.log.close()
+                ctx.log = None
+
+    def run(self):
+        pending = list(self.jobs)
+        running = {}
+        done = set()
+        with concurrent.futures.ThreadPoolExecutor(self.workers) as pool:
+            try:
+                while pending or running:
+                    if s.cancelled.is_set():
+                        pending = []
+                    for key in [x for x in pending if any(y in s.failed for y in self.jobs[x][1])]:
+                        print("Skipping", " ".join(key), "because a job it needs failed")
+                        pending.remove(key)
+                        s.failed.add(key)
+                    for key in [x for x in pending if self.ready(x, done)]:
+                        if len(running) == self.workers:
+                            break
+                        pending.remove(key)
+                        running[pool.submit(self.run_job, key)] = key
+                    if not running:
+                        if pending:
+                            raise RuntimeError("Dependency cycle between " +
+                                ", ".join(" ".join(x) for x in pending))
+                        break
+                    finished, _ = concurrent.futures.wait(running,
+                        return_when = concurrent.futures.FIRST_COMPLETED)
+                    for future in finished:
+                        key = running.pop(future)
+                        try:
+                            future.result()
+                            done.add(key)
+                        except Cancelled:
+                            s.failed.add(key)
+                        except Exception as e:
+                            report_failure(e, key)
+                            s.failed.add(key)
+                            s.failures.append(key)
+                            if not args.keep_going:
+                                cancel()
+            except KeyboardInterrupt:
+                # the commands run in their own sessions and do not see the
+                # Ctrl-C, stop them before the pool waits for the jobs
+                cancel()
+                raise
+        self.jobs = {}
+        if s.cancelled.is_set():
+            raise Cancelled("stopped after " + " ".join(s.failures[0]) + " failed")
+
+# while installing the libraries this only adds jobs to the shared scheduler
+def for_architectures(f, name, library = None):
+    scheduler = s.scheduler or Scheduler(args.parallel_archs)
+    for arch in s.architectures:
+        needs = [(x, arch) for x in s.dependencies.get(library, [])]
+        log = args.path + "/output-" + arch.replace(" ", "_") + "/build/" + name + ".log"
+        scheduler.add((library or name, arch), functools.partial(f, arch),
+            needs, log)
+    if scheduler is not s.scheduler:
+        scheduler.run()
 
 # see https://developer.android.com/ndk/guides/other_build_systems
 def setup_host(arch):
@@ -273,6 +1100,9 @@ def setup_host(arch):
     minsdk = s.min_api[arch]
     install = args.path + "/output-" + arch.replace(" ", "_")
 
+    # every architecture gets its own copy of the environment, so they can
+    # be set up side by side
+    ctx.env = dict(os.environ)
     set_var("ANDROID_NDK_ROOT", s.ndk)
     set_var("ANDROID_HOME", s.sdk)
     set_var("ANDROID_NDK_TOOLCHAIN_ROOT", toolchain)
@@ -283,10 +1113,21 @@ def setup_host(arch):
     set_var("LD", toolchain + "/bin/" + host + "-ld")
     set_var("RANLIB", toolchain + "/bin/" + host + "-ranlib")
     set_var("STRIP", toolchain + "/bin/" + host + "-strip")
-    set_var("CC", toolchain + "/bin/" + host2 + minsdk + "-clang")
-    set_var("CXX", toolchain + "/bin/" + host2 + minsdk + "-clang++")
+    launcher = args.launcher + " " if args.launcher else ""
+    set_var("CC", launcher + toolchain + "/bin/" + host2 + minsdk + "-clang")
+    set_var("CXX", launcher + toolchain + "/bin/" + host2 + minsdk + "-clang++")
     set_var("CFLAGS", "-fPIC")
-    backup_path()
+    if args.optimize:
+        cflags, ldflags = s.profiles[args.optimize]
+        cflags = ["-fPIC"] + cflags + s.abi_flags.get(arch, [])
+        set_var("CFLAGS", " ".join(cflags))
+        set_var("CXXFLAGS", " ".join(cflags))
+        set_var("LDFLAGS", " ".join(ldflags))
+        if "-flto=thin" in cflags:
+            # the archives must have an index of the symbols in the bitcode
+            set_var("AR", toolchain + "/bin/llvm-ar")
+            set_var("RANLIB", toolchain + "/bin/llvm-ranlib")
+    set_var("MAKEFLAGS", s.jobserver.makeflags())
     add_path(s.ndk)
     add_path(s.sdk)
     add_path(toolchain + "/bin")
@@ -295,50 +1136,328 @@ def setup_host(arch):
 
     return host, install
 
-def build_architectures(path, configure):
+# CMake only takes the flags from the environment for a new build tree
+def cmake_flags(arch):
+    options = ["-DCMAKE_C_FLAGS=" + ctx.env["CFLAGS"]]
+    if args.optimize:
+        options += ["-DCMAKE_CXX_FLAGS=" + ctx.env["CXXFLAGS"],
+            "-DCMAKE_SHARED_LINKER_FLAGS=" + ctx.env["LDFLAGS"],
+            "-DCMAKE_EXE_LINKER_FLAGS=" + ctx.env["LDFLAGS"],
+            "-DCMAKE_AR=" + ctx.env["AR"],
+            "-DCMAKE_RANLIB=" + ctx.env["RANLIB"]]
+        if arch == "armeabi-v7a":
+            options += ["-DANDROID_ARM_NEON=ON"]
+    return options
+
+# the install path is left out, so keys are the same on every host
+def stamp_key(*inputs):
+    text = json.dumps(inputs).replace(args.path, "<path>")
+    return hashlib.sha256(text.encode("utf8")).hexdigest()
+
+def read_stamp(stamp):
+    if not os.path.exists(stamp):
+        return None
+    return open(stamp).read().strip()
+
+def up_to_date(stamp, key):
+    return not args.rebuild and read_stamp(stamp) == key
+
+def write_stamp(stamp, key):
+    os.makedirs(os.path.dirname(stamp), exist_ok = True)
+    with open(temp_name(stamp), "w") as f:
+        f.write(key + "\n")
+    os.replace(temp_name(stamp), stamp)
+
+def link_tree(source, destination):
+    for root, folders, files in os.walk(source):
+        target = destination + root[len(source):]
+        os.makedirs(target, exist_ok = True)
+        for x in files:
+            f = root + "/" + x
+            t = target + "/" + x
+            if os.path.islink(f):
+                if not os.path.islink(t):
+                    os.symlink(os.readlink(f), t)
+                continue
+            if os.path.exists(t):
+                if os.path.samefile(f, t):
+                    continue
+                os.unlink(t)
+            try:
+                os.link(f, t)
+            except OSError:
+                shutil.copy2(f, t)
+
+def tree_files(source):
+    files = {}
+    for root, folders, names in os.walk(source):
+        for x in names:
+            files[os.path.relpath(root + "/" + x, source)] = root + "/" + x
+    return files
+
+# copies only files whose size or modification time differ
+def sync_files(files, destination, delete = True):
+    copied = removed = 0
+    for name, source in files.items():
+        t = destination + "/" + name
+        if os.path.exists(t):
+            a, b = os.stat(source), os.stat(t)
+            if a.st_size == b.st_size and a.st_mtime_ns == b.st_mtime_ns:
+                continue
+        os.makedirs(os.path.dirname(t), exist_ok = True)
+        shutil.copy2(source, temp_name(t))
+        os.replace(temp_name(t), t)
+        copied += 1
+    if delete:
+        for name in tree_files(destination):
+            if name not in files:
+                os.unlink(destination + "/" + name)
+                removed += 1
+    print("sync", destination + ":", copied, "copied,", removed, "removed")
+
+# sorted entries with a fixed date and mode, so the same files give the same zip
+def write_zip(name, folder):
+    print("zip", name)
+    top = os.path.basename(folder)
+    files = tree_files(folder)
+    with zipfile.ZipFile(temp_name(name), "w", zipfile.ZIP_DEFLATED) as z:
+        for x in sorted(files):
+            info = zipfile.ZipInfo(top + "/" + x, (1980, 1, 1, 0, 0, 0))
+            mode = 0o755 if os.access(files[x], os.X_OK) else 0o644
+            info.external_attr = (stat.S_IFREG | mode) << 16
+            info.compress_type = zipfile.ZIP_DEFLATED
+            with open(files[x], "rb") as f:
+                z.writestr(info, f.read())
+    os.replace(temp_name(name), name)
+
+def merge_tree(source, destination):
+    for root, folders, files in os.walk(source):
+        target = destination + root[len(source):]
+        os.makedirs(target, exist_ok = True)
+        for x in files:
+            os.replace(root + "/" + x, target + "/" + x)
+    shutil.rmtree(source)
+
+# fixes the prefix in pkg-config and libtool files
+def relocate(folder, old, new):
+    for root, folders, files in os.walk(folder):
+        for x in files:
+            f = root + "/" + x
+            if os.path.islink(f):
+                continue
+            data = open(f, "rb").read()
+            if b"\0" in data[:8192] or old.encode("utf8") not in data:
+                continue
+            open(f, "wb").write(data.replace(old.encode("utf8"), new.encode("utf8")))
+
+def restore_artifact(name, root, prefix):
+    if not args.artifacts:
+        return False
+    path = prefix + "/stage/" + name
+    rm(path)
+    # the cache is optional, anything going wrong with it means building
+    try:
+        if "://" in args.artifacts:
+            try:
+                download(args.artifacts.rstrip("/") + "/" + name, path)
+            except urllib.error.HTTPError as e:
+                if e.code == 404:
+                    return False
+                raise
+        elif os.path.exists(args.artifacts + "/" + name):
+            shutil.copyfile(args.artifacts + "/" + name, path)
+        else:
+            return False
+        print("Restoring", name)
+        shutil.rmtree(root, ignore_errors = True)
+        with tarfile.open(path) as t:
+            # the data filter checks the same, where Python has it
+            extra = {"filter" : "data"} if hasattr(tarfile, "data_filter") else {}
+            t.extractall(root, members = safe_members(t), **extra)
+        old = open(root + "/.prefix").read()
+    except (OSError, tarfile.TarError) as e:
+        print("Could not restore", name + ", building it:", e)
+        shutil.rmtree(root, ignore_errors = True)
+        rm(path)
+        return False
+    os.unlink(path)
+    os.unlink(root + "/.prefix")
+    if old != prefix:
+        relocate(root, old, prefix)
+    return True
+
+# the archives come from a shared server, nothing may end up outside root
+def safe_members(t):
+    for member in t:
+        for x in [member.name] + ([member.linkname] if member.issym() or member.islnk() else []):
+            if x.startswith("/") or ".." in x.split("/"):
+                raise tarfile.TarError("Refusing to unpack " + member.name)
+        if not (member.isfile() or member.isdir() or member.issym() or member.islnk()):
+            raise tarfile.TarError("Refusing to unpack " + member.name)
+        yield member
+
+def publish_artifact(name, root, prefix):
+    if not args.artifacts:
+        return
+    path = prefix + "/stage/" + name
+    with tarfile.open(path, "w:gz") as t:
+        info = tarfile.TarInfo(".prefix")
+        info.size = len(prefix.encode("utf8"))
+        t.addfile(info, io.BytesIO(prefix.encode("utf8")))
+        t.add(root, ".")
+    print("Publishing", name)
+    if "://" in args.artifacts:
+        with open(path, "rb") as f:
+            req = urllib.request.Request(args.artifacts.rstrip("/") + "/" + name,
+                data = f, method = "PUT")
+            req.add_header("Content-Length", str(os.path.getsize(path)))
+            req.add_header("Content-Type", "application/gzip")
+            try:
+                urllib.request.urlopen(req).close()
+            except urllib.error.URLError as e:
+                print("Could not publish", name + ":", e)
+    else:
+        os.makedirs(args.artifacts, exist_ok = True)
+        shutil.copyfile(path, temp_name(args.artifacts + "/" + name))
+        os.replace(temp_name(args.artifacts + "/" + name), args.artifacts + "/" + name)
+    os.unlink(path)
+
+# skipped as long as the stamp in output-<arch>/stamps is up to date
+def build_architectures(path, configure, library = None):
     slash = path.rfind("/")
     name = path[slash + 1:]
-    for arch in s.architectures:
-        print("Building", path, "for", arch)
+    def build(arch):
         host, install = setup_host(arch)
+        if args.optimize:
+            # keep the symbols of the static libraries out of the dynamic
+            # symbol table of the Allegro libraries linking them
+            set_var("CFLAGS", ctx.env["CFLAGS"] + " -fvisibility=hidden")
+            set_var("CXXFLAGS", ctx.env["CXXFLAGS"] + " -fvisibility=hidden")
+        stamps = install + "/stamps/"
+        key = stamp_key(s.checksums.get(path), getattr(configure, "flags", None),
+            [ctx.env[x] for x in ["ANDROID_NDK_TOOLCHAIN_ROOT", "CC", "CXX", "CFLAGS"]],
+            s.checksums.get(s.ndk), s.min_api[arch],
+            [read_stamp(stamps + x) for x in s.dependencies.get(library, [])])
+        # --watch rebuilds libraries whose unpacked sources were changed,
+        # those builds are not the ones of the archive and never shared
+        modified = library in s.modified
+        if not modified and up_to_date(stamps + (library or name), key):
+            print(path, "for", arch, "is up to date")
+            restore_env()
+            return
+        artifact = (library or name) + "-" + arch + "-" + key + ".tar.gz"
+        stage = install + "/stage/" + name
+        os.makedirs(install + "/stage", exist_ok = True)
+        if not modified and restore_artifact(artifact, stage, install):
+            merge_tree(stage, install)
+            write_stamp(stamps + (library or name), key)
+            restore_env()
+            return
+        print("Building", path, "for", arch)
+        shutil.rmtree(stage, ignore_errors = True)
+        set_var("DESTDIR", stage)
         
         destination = install + "/build/" + name
-        if not os.path.exists(destination):
-            shutil.copytree(path, destination)
+        if getattr(configure, "out_of_tree", False):
+            if os.path.exists(destination + "/configure") or os.path.exists(destination + "/CMakeLists.txt"):
+                # a full copy of the sources from an older version of this script
+                shutil.rmtree(destination)
+            os.makedirs(destination, exist_ok = True)
+        else:
+            link_tree(path, destination)
         chdir(destination)
         
-        configure(arch, host, install)
-        restore_path()
+        configure(arch, host, install, path)
+        if not modified:
+            publish_artifact(artifact, stage + install, install)
+        merge_tree(stage + install, install)
+        shutil.rmtree(stage)
+        write_stamp(stamps + (library or name), key)
+        restore_env()
+    for_architectures(build, name, library)
 
 def configure_f(*extras):
-    def f(arch, host, prefix):
-        if not os.path.exists("configure"):
-            com("./autogen.sh")
-        com("./configure", "--host=" + host, "--prefix=" + prefix, *extras)
-        com("make", "-j4")
+    def f(arch, host, prefix, source):
+        with autogen_lock:
+            if not os.path.exists(source + "/configure"):
+                build = ctx.cwd
+                chdir(source)
+                com("./autogen.sh")
+                chdir(build)
+        com(source + "/configure", "--host=" + host, "--prefix=" + prefix, *extras)
+        com("make")
         com("make", "install")
+    f.flags = ["configure"] + list(extras)
+    f.out_of_tree = True
     return f
 
+def cmake_generator():
+    options = []
+    if args.ninja:
+        options += ["-G", "Ninja"]
+    if args.launcher:
+        options += ["-DCMAKE_C_COMPILER_LAUNCHER=" + args.launcher,
+            "-DCMAKE_CXX_COMPILER_LAUNCHER=" + args.launcher]
+    return options
+
+# CMake refuses to switch generators in an existing build tree
+def same_generator(build):
+    cache = build + "/CMakeCache.txt"
+    if not os.path.exists(cache):
+        return False
+    generator = "Ninja" if args.ninja else "Unix Makefiles"
+    return "CMAKE_GENERATOR:INTERNAL=" + generator + "\n" in open(cache).read()
+
+# make takes its jobs from the jobserver, for Ninja we take the free tokens
+def cmake_build(*options):
+    if not args.ninja:
+        com("make", *options)
+        return
+    tokens = []
+    while len(tokens) < s.jobserver.jobs - 1:
+        token = s.jobserver.try_acquire()
+        if not token:
+            break
+        tokens.append(token)
+    try:
+        com("ninja", "-j" + str(len(tokens) + 1), *options)
+    finally:
+        for token in tokens:
+            s.jobserver.release(token)
+
 def cmake_f(*extras):
     cmake_toolchain = s.ndk + "/build/cmake/android.toolchain.cmake"
-    def f(arch, host, prefix):
-        com("cmake", "-DCMAKE_TOOLCHAIN_FILE=" + cmake_toolchain,
+    def f(arch, host, prefix, source):
+        # the generator may have changed since the last build
+        rm(ctx.cwd + "/CMakeCache.txt")
+        com("cmake", source, "-DCMAKE_TOOLCHAIN_FILE=" + cmake_toolchain,
             "-DANDROID_ABI=" + arch,
             "-DCMAKE_INSTALL_PREFIX=" + prefix,
+            *cmake_generator(),
+            *cmake_flags(arch),
             *extras)
-        com("make", "-j4")
-        com("make", "install")
+        cmake_build()
+        cmake_build("install")
+    f.flags = ["cmake"] + cmake_generator() + list(extras)
+    f.out_of_tree = True
     return f
 
+def install_libraries(libraries):
+    s.scheduler = Scheduler(max(args.workers, args.parallel_archs))
+    for library in libraries:
+        globals()["install_" + library]()
+    s.scheduler.run()
+    s.scheduler = None
+
 def install_freetype():
     ft_orig = download_and_unpack(s.freetype_url)
     build_architectures(ft_orig, configure_f("--without-png", "--without-harfbuzz",
             "--with-zlib=no",
-            "--with-bzip2=no"))
+            "--with-bzip2=no"), "freetype")
 
 def install_ogg():
     ogg_orig = download_and_unpack(s.ogg_url)
-    build_architectures(ogg_orig, configure_f())
+    build_architectures(ogg_orig, configure_f(), "ogg")
 
 def install_vorbis():
     vorbis_orig = download_and_unpack(s.vorbis_url)
@@ -346,59 +1465,68 @@ def install_vorbis():
     # need to patch libvorbis 1.3.5 to work with clang on i386
     print("Patching libvorbis 1.3.5")
     b = open(vorbis_orig + "/configure").read()
-    b = b.replace("-mno-ieee-fp", "")
-    open(vorbis_orig + "/configure", "w").write(b)
+    # only written the first time, so --watch-libraries sees no change
+    if "-mno-ieee-fp" in b:
+        b = b.replace("-mno-ieee-fp", "")
+        open(vorbis_orig + "/configure", "w").write(b)
 
-    build_architectures(vorbis_orig, configure_f())
+    build_architectures(vorbis_orig, configure_f(), "vorbis")
 
 def install_png():
     png_orig = download_and_unpack(s.png_url)
-    build_architectures(png_orig, configure_f())
+    build_architectures(png_orig, configure_f(), "png")
 
 def install_physfs():
     physfs_orig = download_and_unpack(s.physfs_url)
-    build_architectures(physfs_orig, cmake_f("-DPHYSFS_BUILD_SHARED=OFF"))
+    build_architectures(physfs_orig, cmake_f("-DPHYSFS_BUILD_SHARED=OFF"), "physfs")
 
 def install_flac():
     flac_orig = download_and_unpack(s.flac_url)
     build_architectures(flac_orig, configure_f(
-            "--disable-cpplibs", "--disable-shared", "--enable-static", "--disable-ogg"))
+            "--disable-cpplibs", "--disable-shared", "--enable-static", "--disable-ogg"), "flac")
 
 def install_opus():
     opus_orig = download_and_unpack(s.opus_url)
     build_architectures(opus_orig, configure_f(
-            "--disable-shared", "--enable-static"))
+            "--disable-shared", "--enable-static"), "opus")
 
 def install_opusfile():
     orig = download_and_unpack(s.opusfile_url)
     build_architectures(orig, configure_f(
-            "--disable-shared", "--enable-static"))
+            "--disable-shared", "--enable-static"), "opusfile")
 
 def install_dumb():
     dumb_orig = download_and_unpack(s.dumb_url)
-    build_architectures(dumb_orig, cmake_f("-DBUILD_EXAMPLES=OFF", "-DBUILD_ALLEGRO4=OFF"))
+    build_architectures(dumb_orig, cmake_f("-DBUILD_EXAMPLES=OFF", "-DBUILD_ALLEGRO4=OFF"), "dumb")
 
 def install_minimp3():
     orig = download_and_unpack(s.minimp3_url)
-    def f(arch, host, install):
-        com("cp", "minimp3.h", install + "/include/")
-        com("cp", "minimp3_ex.h", install + "/include/")
-    build_architectures(orig, f)
+    def f(arch, host, install, source):
+        include = ctx.env["DESTDIR"] + install + "/include/"
+        makedirs(include)
+        com("cp", "minimp3.h", include)
+        com("cp", "minimp3_ex.h", include)
+    build_architectures(orig, f, "minimp3")
 
 def install_theora():
     orig = download_and_unpack(s.theora_url)
     build_architectures(orig, configure_f(
-            "--disable-shared", "--enable-static"))
+            "--disable-shared", "--enable-static"), "theora")
+
+def allegro_name(variant):
+    return "allegro-debug" if variant == "debug" else "allegro"
 
+# every variant builds in its own folder, so they can run side by side
 def build_allegro():
-    for arch in s.architectures:
-        print("Building Allegro for", arch)
+    def build_arch(arch, variant):
+        print("Building Allegro", variant, "for", arch)
         
         host, install = setup_host(arch)
-        build = install + "/build/allegro"
-        if args.debug:
-            build += "-debug"
-        shutil.rmtree(build, ignore_errors = True)
+        name = allegro_name(variant)
+        prefix = install + "/" + name
+        build = install + "/build/" + name
+        if not args.incremental or not same_generator(build):
+            shutil.rmtree(build, ignore_errors = True)
         makedirs(build)
         chdir(build)
 
@@ -408,111 +1536,200 @@ def build_allegro():
         if arch == "armeabi":
             extra = "-DWANT_ANDROID_LEGACY=on"
 
-        debug = "Release"
-        if args.debug:
-            debug = "Debug"
         include = install + "/include"
-        com("cmake", args.allegro, "-DCMAKE_TOOLCHAIN_FILE=" + cmake_toolchain,
+        lib = install + "/lib/"
+        # where Allegro finds each library, only passed if it was built
+        libraries = {
+            "ogg" : ["-DOGG_LIBRARY=" + lib + "libogg.a",
+                "-DOGG_INCLUDE_DIR=" + include],
+            "vorbis" : ["-DVORBIS_LIBRARY=" + lib + "libvorbis.a",
+                "-DVORBIS_INCLUDE_DIR=" + include,
+                "-DVORBISFILE_LIBRARY=" + lib + "libvorbisfile.a",
+                "-DSUPPORT_VORBIS=true"],
+            "freetype" : ["-DFREETYPE_LIBRARY=" + lib + "libfreetype.a",
+                "-DFREETYPE_INCLUDE_DIRS=" + include + ";" + include + "/freetype2"],
+            #"png" : ["-DPNG_INCLUDE_DIR=" + include,
+            #    "-DPNG_LIBRARY=" + lib + "libpng.a"],
+            "flac" : ["-DFLAC_LIBRARY=" + lib + "libFLAC.a",
+                "-DFLAC_INCLUDE_DIR=" + include],
+            "physfs" : ["-DPHYSFS_LIBRARY=" + lib + "libphysfs.a",
+                "-DPHYSFS_INCLUDE_DIR=" + include],
+            "opus" : ["-DOPUS_LIBRARY=" + lib + "libopus.a",
+                "-DOPUS_INCLUDE_DIR=" + include + "/opus"],
+            "opusfile" : ["-DOPUSFILE_LIBRARY=" + lib + "libopusfile.a"],
+            "dumb" : ["-DDUMB_LIBRARY=" + lib + "libdumb.a",
+                "-DDUMB_INCLUDE_DIR=" + include],
+            "minimp3" : ["-DMINIMP3_INCLUDE_DIRS=" + include],
+            #"theora" : ["-DTHEORA_LIBRARY=" + lib + "libtheora.a",
+            #    "-DTHEORA_INCLUDE_DIR=" + include],
+            }
+        build_type = variant.capitalize()
+        if variant == "release" and args.optimize == "size":
+            # the -O3 of Release would come after the profile's -Os
+            build_type = "MinSizeRel"
+        options = [args.allegro, "-DCMAKE_TOOLCHAIN_FILE=" + cmake_toolchain,
+            *cmake_generator(),
+            *cmake_flags(arch),
             "-DANDROID_ABI=" + arch,
-            "-DCMAKE_BUILD_TYPE=" + debug,
+            "-DCMAKE_BUILD_TYPE=" + build_type,
             "-DANDROID_TARGET=android-26",
-            "-DCMAKE_INSTALL_PREFIX=" + install,
+            "-DCMAKE_INSTALL_PREFIX=" + prefix,
             extra,
             "-DWANT_DEMO=off",
             "-DWANT_EXAMPLES=off",
             "-DWANT_TESTS=off",
             "-DWANT_DOCS=off",
             "-DPKG_CONFIG_EXECUTABLE=/usr/bin/pkg-config",
-            "-DOGG_LIBRARY=" + install + "/lib/libogg.a",
-            "-DOGG_INCLUDE_DIR=" + include,
-            "-DVORBIS_LIBRARY=" + install + "/lib/libvorbis.a",
-            "-DVORBIS_INCLUDE_DIR=" + include,
-            "-DVORBISFILE_LIBRARY=" + install + "/lib/libvorbisfile.a",
-            "-DSUPPORT_VORBIS=true",
-            "-DFREETYPE_LIBRARY=" + install + "/lib/libfreetype.a",
-            "-DFREETYPE_INCLUDE_DIRS=" + install + "/include;" + install + "/include/freetype2",
-            #"-DPNG_INCLUDE_DIR=" + install + "/include",
-            #"-DPNG_LIBRARY=" + install + "/lib/libpng.a",
-            "-DFLAC_LIBRARY=" + install + "/lib/libFLAC.a",
-            "-DFLAC_INCLUDE_DIR=" + include,
-            "-DPHYSFS_LIBRARY=" + install + "/lib/libphysfs.a",
-            "-DPHYSFS_INCLUDE_DIR=" + include,
-            "-DOPUS_LIBRARY=" + install + "/lib/libopus.a",
-            "-DOPUS_INCLUDE_DIR=" + include + "/opus",
-            "-DOPUSFILE_LIBRARY=" + install + "/lib/libopusfile.a",
-            "-DDUMB_LIBRARY=" + install + "/lib/libdumb.a",
-            "-DDUMB_INCLUDE_DIR=" + include,
-            "-DMINIMP3_INCLUDE_DIRS=" + include,
-            #"-DTHEORA_LIBRARY=" + install + "/lib/libtheora.a",
-            #"-DTHEORA_INCLUDE_DIR=" + include,
-            )
+            "-DWANT_MONOLITH=" + ("on" if args.monolith else "off"),
+            ]
+        for library in s.components:
+            options += libraries.get(library, [])
+        for library, switches in s.allegro_options.items():
+            on = "on" if library in s.components else "off"
+            options += ["-D" + x + "=" + on for x in switches]
+
+        # with --incremental CMake only runs again if its options changed,
+        # otherwise the build system takes care of any changed sources
+        stamp = build + "/.cmake_stamp"
+        key = stamp_key([x for x in options if x is not None],
+            [ctx.env[x] for x in ["CC", "CXX", "CFLAGS"]])
+        if up_to_date(stamp, key) and same_generator(build):
+            print("CMake configuration is up to date")
+        else:
+            com("cmake", *options)
+            write_stamp(stamp, key)
             
-        com("make", "-j4", "VERBOSE=1")
+        cmake_build("-v" if args.ninja else "VERBOSE=1")
         # Get rid of previously installed files, so for example we get
-        # no debug libaries in a release build.
-        rm(install + "/lib/liballegro*")
-        com("make", "install")
+        # no libraries of addons which are not built any longer. The
+        # install step copies every missing file again, also when nothing
+        # was rebuilt.
+        rm(prefix + "/lib/liballegro*")
+        cmake_build("install")
         
-        restore_path()
+        restore_env()
+    s.scheduler = Scheduler(args.parallel_archs * len(args.variants))
+    for variant in args.variants:
+        name = allegro_name(variant)
+        for_architectures(functools.partial(build_arch, variant = variant),
+            name, name)
+    s.scheduler.run()
+    s.scheduler = None
+
+def llvm_tool(name):
+    return s.ndk + "/toolchains/llvm/prebuilt/linux-x86_64/bin/llvm-" + name
+
+# which static library defines each symbol
+def archive_symbols(install):
+    owners = {}
+    for library in s.components:
+        for archive in s.archives.get(library, []):
+            path = install + "/lib/" + archive
+            if not os.path.exists(path):
+                continue
+            for row in query(llvm_tool("nm"), "--defined-only", "--format=posix", path).splitlines():
+                parts = row.split()
+                if len(parts) >= 2 and len(parts[1]) == 1:
+                    owners.setdefault(parts[0], library)
+    return owners
+
+def measure_library(so, owners):
+    sections = {}
+    for row in query(llvm_tool("readelf"), "--sections", "--wide", so).splitlines():
+        m = re.search(r"\]\s+(\S+)\s+\S+\s+[0-9a-f]+\s+[0-9a-f]+\s+([0-9a-f]+)\s", row)
+        if m and m.group(1) != "NULL":
+            sections[m.group(1)] = int(m.group(2), 16)
+    # without a symbol table only the exported symbols are known
+    dynamic = [] if ".symtab" in sections else ["--dynamic"]
+    symbols = []
+    for row in query(llvm_tool("nm"), "--defined-only", "--print-size", "--format=posix",
+            *dynamic, so).splitlines():
+        parts = row.split()
+        if len(parts) == 4:
+            symbols.append((parts[0], int(parts[3], 16)))
+    added = collections.Counter()
+    for name, size in symbols:
+        added[owners.get(name, "allegro")] += size
+    stripped = temp_name(so)
+    try:
+        query(llvm_tool("strip"), "--strip-all", "-o", stripped, so)
+        stripped_size = os.path.getsize(stripped)
+    finally:
+        if os.path.exists(stripped):
+            os.unlink(stripped)
+    symbols.sort(key = lambda x: -x[1])
+    return {"size" : os.path.getsize(so),
+        "stripped" : stripped_size,
+        "sections" : sections,
+        "symbols" : [{"name" : x, "size" : y, "library" : owners.get(x, "allegro")}
+            for x, y in symbols[:s.size_symbols]],
+        "libraries" : dict(added.most_common())}
+
+def size_report():
+    report = {}
+    for variant in args.variants:
+        name = allegro_name(variant)
+        for arch in s.architectures:
+            install = args.path + "/output-" + arch.replace(" ", "_")
+            libraries = sorted(glob.glob(install + "/" + name + "/lib/liballeg*.so"))
+            if (name, arch) in s.failed or not libraries:
+                continue
+            owners = archive_symbols(install)
+            sizes = {os.path.basename(x) : measure_library(x, owners) for x in libraries}
+            report.setdefault(variant, {})[arch] = {
+                "size" : sum(x["size"] for x in sizes.values()),
+                "stripped" : sum(x["stripped"] for x in sizes.values()),
+                "libraries" : sizes}
+
+    exceeded = []
+    checked = set()
+    for arch, x in report.get("release", {}).items():
+        for budget_name, budget in s.budgets.items():
+            if budget_name in ("", arch):
+                what, size = arch, x["stripped"]
+            elif budget_name in x["libraries"]:
+                what, size = arch + " " + budget_name, x["libraries"][budget_name]["stripped"]
+            else:
+                continue
+            checked.add(budget_name)
+            if size > budget:
+                exceeded.append({"name" : what, "size" : size, "budget" : budget})
+    if s.budgets and "release" not in report:
+        print("Warning: no release libraries were measured, size budgets not checked")
+    elif "release" in report:
+        for budget_name in s.budgets:
+            if budget_name not in checked:
+                print("Warning: size budget for " + budget_name + " not checked, it was not built")
+
+    name = args.path + "/install_android.sizes.json"
+    json.dump({"variants" : report, "exceeded" : exceeded}, open(name, "w"), indent = 1)
+    for variant, architectures in report.items():
+        for arch, x in architectures.items():
+            print()
+            print("%s %s: %d KB, %d KB stripped" % (arch, variant, x["size"] >> 10, x["stripped"] >> 10))
+            for so, y in x["libraries"].items():
+                added = ", ".join("%s %d KB" % (z, n >> 10) for z, n in y["libraries"].items() if n >= 1024)
+                print("  %-28s %6d KB %6d KB stripped  %s" % (so, y["size"] >> 10, y["stripped"] >> 10, added))
+    print("size report written to", name)
+
+    for x in exceeded:
+        sys.stderr.write("FAILED: %s is %d bytes, over its size budget of %d\n" % (x["name"], x["size"], x["budget"]))
+        key = ("size budget",) + tuple(x["name"].split(" "))
+        s.failed.add(key)
+        s.failures.append(key)
+    if exceeded and not args.keep_going:
+        raise Cancelled("stopped because libraries are over their size budget")
 
 def build_aar():
-    shutil.rmtree(args.path + "/gradle_project", ignore_errors = True)
-    copy(args.allegro + "/android/gradle_project", args.path + "/gradle_project")
+    # the files written below are left out, otherwise every run would copy
+    # and write them again
+    generated = ["allegro/src/main/AndroidManifest.xml", "allegro/build.gradle",
+        "gradle.properties", "local.properties", "build.gradle", "settings.gradle"]
+    template = tree_files(args.allegro + "/android/gradle_project")
+    sync_files({x : f for x, f in template.items() if x not in generated},
+        args.path + "/gradle_project", delete = False)
     
     allegro5 = args.path + "/gradle_project/allegro"
-    includes = args.path + "/gradle_project/allegro_jni_includes"
-    if args.debug:
-        includes += "_debug"
-
-    for arch in s.architectures:
-        install = args.path + "/output-" + arch.replace(" ", "_")
-        makedirs(allegro5 + "/src/main/jniLibs/" + arch)
-        for so in glob.glob(install + "/lib/liballeg*"):
-            copy(so, allegro5 + "/src/main/jniLibs/" + arch + "/")
-    
-    makedirs(includes + "/jniIncludes")
-    # Note: the Allegro headers are the same for all architectures, so just copy from the first one
-    copy(args.path + "/output-" + s.architectures[0] + "/include/allegro5",   includes + "/jniIncludes/")
-    copy(allegro5 + "/src/main/jniLibs", includes)
-
-    write(includes + "/allegro.cmake",
-"""
-get_filename_component(ABI ${CMAKE_BINARY_DIR} NAME)
-set(base ${CMAKE_CURRENT_LIST_DIR})
-
-macro(standard_library NAME)
-    string(TOUPPER ${NAME} UNAME)
-    find_library(LIB_${UNAME} ${NAME})
-    target_link_libraries(${NATIVE_LIB} ${LIB_${UNAME}})
-endmacro()
-
-macro(allegro_library NAME)
-    string(TOUPPER ${NAME} UNAME)
-    set(path ${JNI_FOLDER}/jniLibs/${ABI}/lib${NAME})
-    if(EXISTS "${path}-debug.so")
-        set(LIB_${UNAME} ${path}-debug.so)
-    elseif(EXISTS "${path}.so")
-        set(LIB_${UNAME} ${path}.so)
-    else()
-        message(SEND_ERROR "${path}.so does not exist")
-    endif()
-    target_link_libraries(${NATIVE_LIB} ${LIB_${UNAME}})
-endmacro()
-
-include_directories(${JNI_FOLDER}/jniIncludes)
-allegro_library(allegro)
-allegro_library(allegro_acodec)
-allegro_library(allegro_audio)
-allegro_library(allegro_color)
-allegro_library(allegro_font)
-allegro_library(allegro_image)
-allegro_library(allegro_primitives)
-allegro_library(allegro_ttf)
-standard_library(m)
-standard_library(z)
-standard_library(log)
-standard_library(GLESv2)
-""")
     write(allegro5 + "/src/main/AndroidManifest.xml", """
 <manifest xmlns:android="http://schemas.android.com/apk/res/android"
     package="org.liballeg.android">
@@ -521,10 +1738,12 @@ standard_library(GLESv2)
     write(args.path + "/gradle_project/gradle.properties", """
 org.gradle.java.home={}
 """.format(s.jdk))
+    # gradle only needs the NDK if it is there, packaging does not fetch it
+    ndk = "ndk.dir=" + s.ndk if os.path.exists(s.ndk) else ""
     write(args.path + "/gradle_project/local.properties", """
-ndk.dir={}
+{}
 sdk.dir={}
-""".format(s.ndk, s.sdk))
+""".format(ndk, s.sdk))
     write(args.path + "/gradle_project/build.gradle", """
 buildscript {
     repositories {
@@ -536,7 +1755,109 @@ buildscript {
     }
 }
 """)
-    debug = "debug" if args.debug else "release"
+    write(args.path + "/gradle_project/settings.gradle", "include ':allegro'")
+
+    for variant in args.variants:
+        if any((allegro_name(variant), x) in s.failed for x in s.architectures):
+            print("Skipping", variant, "package because building it failed")
+            continue
+        with timed("step", "package " + variant):
+            package_variant(variant)
+
+def package_variant(variant):
+    allegro5 = args.path + "/gradle_project/allegro"
+    includes = args.path + "/gradle_project/allegro_jni_includes"
+    if variant == "debug":
+        includes += "_debug"
+    name = allegro_name(variant)
+
+    # replaces the libraries of the variant packaged before
+    libs = {}
+    for arch in s.architectures:
+        prefix = args.path + "/output-" + arch.replace(" ", "_") + "/" + name
+        for so in glob.glob(prefix + "/lib/liballeg*"):
+            libs[arch + "/" + os.path.basename(so)] = so
+    # each variant has its own source set, so packaging both does not swap
+    # the libraries of one for the other every time
+    sync_files({}, allegro5 + "/src/main/jniLibs")
+    sync_files(libs, allegro5 + "/src/" + variant + "/jniLibs")
+    sync_files(libs, includes + "/jniLibs")
+    # Note: the Allegro headers are the same for all architectures, so just copy from the first one
+    sync_files(tree_files(args.path + "/output-" + s.architectures[0] + "/" + name + "/include/allegro5"),
+        includes + "/jniIncludes/allegro5")
+
+    # only the addons which were built, Allegro leaves out those missing
+    # a library they need, by the name of their file in this variant
+    jni = allegro5 + "/src/" + variant + "/jniLibs/" + s.architectures[0] + "/"
+    addons = []
+    for x in (["allegro_monolith"] if args.monolith else s.addons):
+        for so in ["lib" + x + "-debug.so", "lib" + x + ".so"]:
+            if os.path.exists(jni + so):
+                addons.append((x, so))
+                break
+    targets = []
+    built = [x for x, so in addons]
+    for x, so in addons:
+        links = s.system_libraries if x in ("allegro", "allegro_monolith") else ["Allegro::allegro"]
+        links = links + ["Allegro::" + y for y in s.addon_dependencies.get(x, []) if y in built]
+        targets.append("allegro_library(" + x + " " + so + " \"" + ";".join(links) + "\")")
+
+    # the headers of the addons packaged, for precompiling
+    packaged = s.addons if args.monolith else built
+    headers = ["#include <allegro5/" + x + ".h>" for x in packaged
+        if os.path.exists(includes + "/jniIncludes/allegro5/" + x + ".h")]
+    write(includes + "/allegro_pch.h", "\n".join(headers))
+
+    write(includes + "/allegro.cmake",
+"""
+# Allegro «version» «variant» for the ABIs «abis», with an IMPORTED
+# target Allegro::<name> for each library and Allegro::all linking all of
+# them. If NATIVE_LIB is set Allegro::all is linked to that target.
+if(TARGET Allegro::all)
+    return()
+endif()
+
+set(ALLEGRO_JNI_FOLDER ${CMAKE_CURRENT_LIST_DIR})
+set(ALLEGRO_ABIS «abis»)
+list(FIND ALLEGRO_ABIS "${ANDROID_ABI}" found)
+if(found EQUAL -1)
+    message(FATAL_ERROR "Allegro was not built for ${ANDROID_ABI}, only for ${ALLEGRO_ABIS}")
+endif()
+
+set(ALLEGRO_LIBRARIES)
+macro(allegro_library NAME FILE LINKS)
+    add_library(Allegro::${NAME} SHARED IMPORTED)
+    set_target_properties(Allegro::${NAME} PROPERTIES
+        IMPORTED_LOCATION ${ALLEGRO_JNI_FOLDER}/jniLibs/${ANDROID_ABI}/${FILE}
+        INTERFACE_INCLUDE_DIRECTORIES ${ALLEGRO_JNI_FOLDER}/jniIncludes
+        INTERFACE_LINK_LIBRARIES "${LINKS}")
+    list(APPEND ALLEGRO_LIBRARIES Allegro::${NAME})
+endmacro()
+
+«addons»
+
+add_library(Allegro::all INTERFACE IMPORTED)
+set_property(TARGET Allegro::all PROPERTY INTERFACE_LINK_LIBRARIES ${ALLEGRO_LIBRARIES})
+
+# Precompiles allegro_pch.h, which includes the headers of all the
+# libraries above, for TARGET. Needs CMake 3.16.
+function(allegro_precompile_headers TARGET)
+    if(CMAKE_VERSION VERSION_LESS 3.16)
+        message(WARNING "Precompiled headers need CMake 3.16, not using them for ${TARGET}")
+        return()
+    endif()
+    target_precompile_headers(${TARGET} PRIVATE ${ALLEGRO_JNI_FOLDER}/allegro_pch.h)
+endfunction()
+
+if(DEFINED NATIVE_LIB)
+    target_link_libraries(${NATIVE_LIB} Allegro::all)
+    if(ALLEGRO_PRECOMPILE_HEADERS)
+        allegro_precompile_headers(${NATIVE_LIB})
+    endif()
+endif()
+""", {"addons" : "\n".join(targets),
+        "abis" : " ".join(s.architectures),
+        "version" : s.version, "variant" : variant})
     write(allegro5 + "/build.gradle", """
 plugins {
     id "com.jfrog.bintray" version "1.7"
@@ -638,17 +1959,195 @@ bintray {
         publish = true
     }
 }
-""", {"version" : s.version, "debug" : debug, "build_tools_version" : s.build_tools_version})
-    write(args.path + "/gradle_project/settings.gradle", "include ':allegro'")
+""", {"version" : s.version, "debug" : variant, "build_tools_version" : s.build_tools_version})
    
-    chdir(args.path + "/gradle_project")
-    com("zip", "-r", includes + ".zip", includes)
-    com("./gradlew", "assembleDebug" if args.debug else "assembleRelease")
+    # sync_files() and write() keep the modification time of what did not
+    # change, so that is enough to tell whether the zip is still current
+    gradle_project = args.path + "/gradle_project"
+    key = stamp_key([[x, os.stat(f).st_size, os.stat(f).st_mtime_ns]
+        for x, f in sorted(tree_files(includes).items())])
+    stamp = gradle_project + "/.stamps/" + os.path.basename(includes)
+    if up_to_date(stamp, key) and os.path.exists(includes + ".zip"):
+        print(includes + ".zip is up to date")
+    else:
+        write_zip(includes + ".zip", includes)
+        write_stamp(stamp, key)
+
+    # gradle is only started if something it packages changed
+    others = tuple("allegro/src/" + x + "/" for x in s.variants if x != variant)
+    inputs = [[x, verified_sha256(f)] for x, f in sorted(tree_files(gradle_project).items())
+        if not x.startswith(("allegro_jni_includes", ".gradle/", ".stamps/") + others)
+        and "/build/" not in "/" + x]
+    key = stamp_key(variant, inputs)
+    stamp = gradle_project + "/.stamps/aar-" + variant
+    chdir(gradle_project)
+    if up_to_date(stamp, key) and glob.glob(allegro5 + "/build/outputs/aar/*" + variant + ".aar"):
+        print("AAR for", variant, "is up to date")
+    else:
+        com("./gradlew", "assemble" + variant.capitalize())
+        write_stamp(stamp, key)
 
     if args.dist:
         com("./gradlew", "bintrayUpload")
         makedirs("/var/www/allegro5.org/android/" + s.version)
         copy(includes + ".zip", "/var/www/allegro5.org/android/" + s.version)
 
+# uses inotifywait if installed, otherwise polls the modification times
+class Watcher:
+    def __init__(self, folders):
+        self.folders = folders
+        self.changes = queue.Queue()
+        self.process = None
+        self.scan_time = 0
+        if shutil.which("inotifywait"):
+            print("Watching with inotifywait")
+            self.process = subprocess.Popen(["inotifywait", "-m", "-r", "-q",
+                "-e", "close_write,create,delete,move", "--format", "%w%f", *folders],
+                stdout = subprocess.PIPE, stderr = subprocess.DEVNULL, text = True)
+            atexit.register(self.process.terminate)
+            threading.Thread(target = self.read, daemon = True).start()
+        else:
+            print("Cannot find inotifywait, watching by polling every", s.watch_poll, "seconds")
+            threading.Thread(target = self.poll, daemon = True).start()
+
+    def ignored(self, name):
+        return any(x.startswith(".") or x.endswith("~") for x in name.split("/"))
+
+    def put(self, name):
+        if not self.ignored(name):
+            self.changes.put(name)
+
+    def read(self):
+        for row in self.process.stdout:
+            self.put(row.rstrip("\n"))
+
+    def scan(self):
+        start = time.time()
+        files = {}
+        for folder in self.folders:
+            for root, folders, names in os.walk(folder):
+                folders[:] = [x for x in folders if not x.startswith(".")]
+                for x in names:
+                    try:
+                        st = os.stat(root + "/" + x)
+                    except FileNotFoundError:
+                        continue
+                    files[root + "/" + x] = st.st_mtime_ns, st.st_size
+        self.scan_time = time.time() - start
+        return files
+
+    def poll(self):
+        files = self.scan()
+        while True:
+            time.sleep(s.watch_poll)
+            now = self.scan()
+            for name in set(files) | set(now):
+                if files.get(name) != now.get(name):
+                    self.put(name)
+            files = now
+
+    # blocks until something changed and nothing more did for --debounce seconds
+    def wait(self):
+        # polling sees the changes of a burst only in the next scan
+        quiet = args.debounce
+        if not self.process:
+            quiet = max(quiet, s.watch_poll + 2 * self.scan_time + 0.25)
+        changed = {self.changes.get()}
+        while True:
+            try:
+                changed.add(self.changes.get(timeout = quiet))
+            except queue.Empty:
+                return changed
+
+def watched_folders():
+    folders = {args.allegro : None}
+    if args.watch_libraries:
+        for library in s.components:
+            folders[unpacked_folder(getattr(s, library + "_url"))] = library
+    return folders
+
+# Allegro links all the libraries, so it is built again after any of them
+def affected(files, folders):
+    libraries = set()
+    allegro = package = False
+    for name in files:
+        for folder, library in folders.items():
+            if name.startswith(folder + "/"):
+                break
+        else:
+            continue
+        relative = name[len(folder) + 1:]
+        if library:
+            libraries.add(library)
+        elif relative.startswith("android/gradle_project/"):
+            package = True
+        elif relative.split("/")[0] not in s.unbuilt:
+            allegro = True
+    allegro = allegro or bool(libraries)
+    return libraries, allegro, package or allegro
+
+# one round of --watch, a failure only ends the round
+def rebuild(libraries, allegro, package):
+    s.cancelled.clear()
+    s.failed = set()
+    s.failures = []
+    s.modified = libraries
+    try:
+        if libraries:
+            with timed("phase", "install"):
+                install_libraries([x for x in s.components if x in libraries])
+        if allegro and args.build:
+            with timed("phase", "build"):
+                build_allegro()
+            if args.size_report:
+                size_report()
+        if package and args.package:
+            print("Packaging version", s.version)
+            with timed("phase", "package"), job_logs("package"):
+                build_aar()
+    except Cancelled as e:
+        sys.stderr.write(str(e) + "\n")
+    except Exception as e:
+        cancel()
+        report_failure(e, ctx.job)
+    finally:
+        s.modified = set()
+        s.scheduler = None
+        restore_env()
+    report_failures()
+
+def watch():
+    folders = watched_folders()
+    # started first, so nothing changed during the first build is missed
+    watcher = Watcher(list(folders))
+    if args.build or args.watch_libraries:
+        provision("build")
+    if args.package:
+        provision("package")
+    libraries, allegro, package = set(), True, True
+    while True:
+        rebuild(libraries, allegro, package)
+        print("Waiting for changes below", args.allegro +
+            (" and the sources of " + str(len(folders) - 1) + " libraries" if len(folders) > 1 else ""))
+        files = watcher.wait()
+        print(len(files), "files changed:", ", ".join(sorted(files)[:5]) +
+            (", ..." if len(files) > 5 else ""))
+        if args.allegro + "/include/allegro5/base.h" in files:
+            parse_version()
+        libraries, allegro, package = affected(files, folders)
+        if not allegro and not package:
+            print("Nothing to build for the changes")
+
 if __name__ == "__main__":
-    main()
+    try:
+        main()
+    except Cancelled as e:
+        sys.stderr.write(str(e) + "\n")
+        sys.exit(1)
+    except KeyboardInterrupt:
+        cancel()
+        raise
+    except Exception as e:
+        cancel()
+        report_failure(e, ctx.job)
+        sys.exit(1)